@@ -0,0 +1,143 @@
+import sys
+import csv
+import json
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .interface import Accessive
+
+
+DEFAULT_CHUNK_SIZE = 10000
+
+
+def read_id_column(handle, column = 0, sep = '\t', header = True):
+    """
+    Yields identifiers from one column of a delimited text stream, one row at a time. The column may be given
+    either as a 0-based index or (if the stream has a header row) as a column name.
+    """
+    reader = csv.reader(handle, delimiter=sep)
+    if header:
+        header_row = next(reader, [])
+        if not str(column).isdigit():
+            column = header_row.index(column)
+    column = int(column)
+    for row in reader:
+        if len(row) > column and row[column]:
+            yield row[column].strip()
+
+
+def _chunked(ids, chunk_size):
+    chunk = []
+    for acc in ids:
+        chunk.append(acc)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def map_stream(ids, out, from_type, to_types = None, taxon = None, require_canonical = None, extensive = False,
+               out_format = 'tsv', chunk_size = DEFAULT_CHUNK_SIZE, workers = 1, sqlite_file = None):
+    """
+    Maps an iterable of identifiers in fixed-size chunks and writes the results to a file-like object as they are
+    produced, so memory use is bounded by chunk_size * workers rather than by the size of the input.
+
+    Each chunk is passed to Accessive.map() with the given arguments, so results are the same as mapping each chunk
+    on its own. Output is either a TSV table (one header row) or JSON lines, one object per source identifier in
+    input order, with the identifier under 'query' and a list of results for each destination type.
+
+    Returns a dict of summary statistics (identifiers read, rows written, elapsed time).
+    """
+    assert(out_format in ['tsv', 'jsonl']), "out_format must be one of 'tsv' or 'jsonl'."
+    local = threading.local()
+
+    def map_chunk(chunk):
+        # A connection runs one query at a time, so each worker opens its own.
+        if not hasattr(local, 'acc'):
+            local.acc = Accessive(sqlite_file)
+        if out_format == 'tsv':
+            result = local.acc.map(chunk, from_type=from_type, to_types=to_types, taxon=taxon,
+                                   require_canonical=require_canonical, extensive=extensive, format='pandas')
+            # Rows come back in database order; put them back in the order the identifiers were read
+            position = {acc: i for i, acc in reversed(list(enumerate(chunk)))}
+            result = result.iloc[sorted(range(len(result)), key=lambda i: position.get(result.index[i], len(chunk)))]
+            return len(chunk), len(result), result.to_csv(sep='\t')
+        else:
+            result = local.acc.map(chunk, from_type=from_type, to_types=to_types, taxon=taxon,
+                                   require_canonical=require_canonical, extensive=extensive, format='json')
+            # 'query' isn't an identifier type, so it can't collide with from_type being among the destination types
+            lines = [json.dumps({'query': acc, **result[acc]}) + '\n' for acc in dict.fromkeys(chunk) if acc in result]
+            return len(chunk), len(lines), ''.join(lines)
+
+    stats = {'ids': 0, 'rows': 0}
+    wrote_header = [False]
+
+    def write_result(future):
+        n_ids, n_rows, text = future.result()
+        if out_format == 'tsv' and wrote_header[0]:
+            text = text.split('\n', 1)[1]
+        wrote_header[0] = True
+        out.write(text)
+        stats['ids'] += n_ids
+        stats['rows'] += n_rows
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in _chunked(ids, chunk_size):
+            pending.append(executor.submit(map_chunk, chunk))
+            if len(pending) > 2*workers:
+                write_result(pending.popleft())
+        while pending:
+            write_result(pending.popleft())
+    out.flush()
+
+    stats['seconds'] = time.time() - start
+    return stats
+
+
+def main(argv = None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m accessive', description="Accessive command-line utilities")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    map_parser = subparsers.add_parser('map', help='Map a column of identifiers from a file or stdin, streaming the results')
+    map_parser.add_argument('input', nargs='?', default='-', help='Input file (default: stdin)')
+    map_parser.add_argument('--from-type', required=True, help='Type of the input identifiers')
+    map_parser.add_argument('--to-types', required=True, help='Comma-separated list of destination identifier types')
+    map_parser.add_argument('--taxon', type=int, default=None, help='Taxon number to restrict the lookup to (recommended)')
+    map_parser.add_argument('--require-canonical', action='store_true', help='Only return canonical identifiers')
+    map_parser.add_argument('--extensive', action='store_true', help='Return all identifiers for the matched entities')
+    map_parser.add_argument('--column', default='0', help='Column to read identifiers from, by name or 0-based index (default: 0)')
+    map_parser.add_argument('--sep', default=None, help='Input field separator (default: comma for .csv files, otherwise tab)')
+    map_parser.add_argument('--no-header', action='store_true', help='Input has no header row')
+    map_parser.add_argument('--format', default='tsv', choices=['tsv', 'jsonl'], help='Output format (default: tsv)')
+    map_parser.add_argument('--output', default='-', help='Output file (default: stdout)')
+    map_parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Identifiers mapped per query')
+    map_parser.add_argument('--workers', type=int, default=1, help='Number of chunks to map in parallel')
+    map_parser.add_argument('--database', default=None, help='SQLite database file (default: the installed database)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'map':
+        sep = args.sep
+        if sep is None:
+            sep = ',' if args.input.endswith('.csv') else '\t'
+        in_handle = sys.stdin if args.input == '-' else open(args.input, 'r', newline='')
+        out_handle = sys.stdout if args.output == '-' else open(args.output, 'w')
+        try:
+            ids = read_id_column(in_handle, args.column, sep, header=not args.no_header)
+            stats = map_stream(ids, out_handle, args.from_type, args.to_types.split(','), args.taxon,
+                               args.require_canonical, args.extensive, args.format, args.chunk_size, args.workers,
+                               args.database)
+        finally:
+            if in_handle is not sys.stdin:
+                in_handle.close()
+            if out_handle is not sys.stdout:
+                out_handle.close()
+        rate = stats['ids'] / stats['seconds'] if stats['seconds'] else 0
+        print(f"Mapped {stats['ids']} identifiers to {stats['rows']} rows in {stats['seconds']:.1f}s ({rate:.0f} identifiers/s)",
+              file=sys.stderr)
@@ -1,3 +1,5 @@
+import re
+
 DATABASE_VERSION = '0.1'
 
 ENTITY_TABLE_COLS = ['taxon INTEGER', 'gene_index INTEGER', 'mrna_index INTEGER', 'prot_index INTEGER']
@@ -19,5 +21,41 @@ KNOWN_IDENTIFIERS = set(GENE_COLS + ISOFORM_COLS + PROTEOFORM_COLS)
 # PDB is *probably* always constant at gene level, because of super high nonspecificity of how PDB works- though it seems like it should be proteoform-specific.
 # Pfam is inconsistent. I'm calling it gene-level for now based on how Ensembl handles it, but again, logically it ought to be proteoform!
 
-
-
+# Identifier types that can carry a '.N' version suffix (NM_001278.3, ENST00000361390.4, etc.)
+VERSIONED_COLS = ['ensembl_gene', 'ensembl_mrna', 'ensembl_prot', 'refseq_mrna', 'refseq_ncrna', 'refseq_peptide', 'ucsc']
+
+# Identifier types that can carry a '-N' isoform suffix (P00750-1) which should still match the parent accession.
+ISOFORM_SUFFIXED_COLS = ['uniprot_swissprot', 'uniprot_trembl']
+
+_VERSION_SUFFIX = re.compile(r'\.\d+$')
+_ISOFORM_SUFFIX = re.compile(r'-\d+$')
+
+def normalize_identifier(identifier, identifier_type):
+    """
+    Returns the lookup key used for match='normalized' queries: case-folded, with version suffixes stripped for
+    versioned identifier types and isoform suffixes stripped for Uniprot accessions. This same function fills the
+    database's 'normalized' columns at build time, so the two sides always agree.
+    """
+    if identifier is None:
+        return None
+    key = identifier.strip().upper()
+    if identifier_type in VERSIONED_COLS:
+        key = _VERSION_SUFFIX.sub('', key)
+    if identifier_type in ISOFORM_SUFFIXED_COLS:
+        key = _ISOFORM_SUFFIX.sub('', key)
+    return key
+
+# Gene-level text columns covered by the FTS5 index that backs Accessive.search()
+TEXT_SEARCH_TABLE = 'gene_text_search'
+TEXT_SEARCH_COLS = ['gene_description', 'gene_name']
+
+# Precomputed direct-lookup tables for frequently requested conversions (see database_ops.build_pair_tables)
+PAIR_TABLE_DIRECTORY = 'pair_table_directory'
+PAIR_DIRECTORY_COLS = ['from_type TEXT', 'to_type TEXT', 'table_name TEXT']
+PAIR_TABLE_COLS = ['taxon INTEGER', 'from_identifier TEXT', 'to_identifier TEXT', 'is_canonical INTEGER']
+
+# Every identifier table has a canonical-only '<name>_canonical' view, which require_canonical queries read through.
+CANONICAL_VIEW_SUFFIX = '_canonical'
+
+# Uniprot's primary gene name for each gene (same columns as an identifier table), used to pick a canonical gene_name
+UNIPROT_PRIMARY_NAME_TABLE = 'uniprot_primary_gene_name'
@@ -3,8 +3,10 @@ import sqlite3
 import requests
 import gzip
 from glob import glob
-from .data_structure import DATABASE_VERSION
+from .data_structure import DATABASE_VERSION, PAIR_TABLE_DIRECTORY, PAIR_DIRECTORY_COLS, PAIR_TABLE_COLS
 import io
+import json
+from collections import Counter
 
 DATABASE_DIRECTORY = os.path.join(os.path.dirname(__file__), 'data')
 DATABASE_FILE = os.path.join(DATABASE_DIRECTORY, f'accessive_db.{DATABASE_VERSION.replace(".", "-")}.sqlite')
@@ -59,6 +61,47 @@ def cleanup_data(force = False):
         print("Files deleted.")
 
 
+def build_pair_tables(query_log_file, sqlite_file = None, top = 3):
+    """
+    Precomputes direct (taxon, from_identifier) -> to_identifier lookup tables for the most frequent conversions
+    in a query log written by Accessive.save_query_log(). Accessive routes single-type conversions through these
+    tables when they exist.
+    """
+    if sqlite_file is None:
+        sqlite_file = DATABASE_FILE
+    with open(query_log_file, 'r') as f:
+        counts = Counter()
+        for entry in json.load(f):
+            counts[(entry['from_type'], entry['to_type'])] += entry['count']
+
+    conn = sqlite3.connect(sqlite_file)
+    c = conn.cursor()
+    c.execute("SELECT identifier_type, entity_type FROM metadata_table")
+    entity_types = dict(c.fetchall())
+    c.execute(f"CREATE TABLE IF NOT EXISTS {PAIR_TABLE_DIRECTORY} ({', '.join(PAIR_DIRECTORY_COLS)})")
+
+    for (from_type, to_type), count in counts.most_common(top):
+        assert(from_type in entity_types and to_type in entity_types), f"Unrecognized identifier types in query log: {from_type}, {to_type}"
+        table_name = f"pair__{from_type}__{to_type}"
+        print(f"Building {table_name} ({count} logged queries)")
+        c.execute(f"DROP TABLE IF EXISTS {table_name}")
+        c.execute(f"CREATE TABLE {table_name} ({', '.join(PAIR_TABLE_COLS)}, PRIMARY KEY (taxon, from_identifier, to_identifier)) WITHOUT ROWID")
+        c.execute(f"""
+                  INSERT INTO {table_name} (taxon, from_identifier, to_identifier, is_canonical)
+                  SELECT et.taxon, f.identifier, t.identifier, MAX(MIN(f.is_canonical, t.is_canonical))
+                  FROM entity_table AS et
+                  JOIN {from_type} AS f ON f.entity_index = et.{entity_types[from_type]}_index AND f.taxon = et.taxon
+                  JOIN {to_type} AS t ON t.entity_index = et.{entity_types[to_type]}_index AND t.taxon = et.taxon
+                  GROUP BY et.taxon, f.identifier, t.identifier
+                  """)
+        c.execute(f"DELETE FROM {PAIR_TABLE_DIRECTORY} WHERE from_type = ? AND to_type = ?", (from_type, to_type))
+        c.execute(f"INSERT INTO {PAIR_TABLE_DIRECTORY} (from_type, to_type, table_name) VALUES (?, ?, ?)", (from_type, to_type, table_name))
+        conn.commit()
+
+    conn.close()
+    print("Pair tables built.")
+
+
 if __name__ == '__main__':
     import argparse
 
@@ -66,11 +109,16 @@ if __name__ == '__main__':
     parser.add_argument('--download', action='store_true', help='Download the latest database')
     parser.add_argument('--cleanup', action='store_true', help='Remove unnecessary files from the Accessive data directory')
     parser.add_argument('--force', action='store_true', help='Force specified operation (download or cleanup) without confirmation')
+    parser.add_argument('--build-pair-tables', metavar='QUERY_LOG', default=None, help='Precompute lookup tables for the most frequent conversions in a query log file')
+    parser.add_argument('--top', type=int, default=3, help='Number of conversions to build pair tables for (default: 3)')
+    parser.add_argument('--database', default=None, help='Database file to operate on (default: the installed database)')
     args = parser.parse_args()
 
     if args.cleanup:
         cleanup_data(args.force)
     if args.download:
         download_database(args.force)
+    if args.build_pair_tables:
+        build_pair_tables(args.build_pair_tables, args.database, args.top)
 
 
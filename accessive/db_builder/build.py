@@ -6,12 +6,14 @@ import gzip
 import tempfile
 import io
 import datetime
+import time
 
 from ..data_structure import *
 from ..database_ops import DATABASE_VERSION, DATABASE_FILE
-from .ensembl import download_ensembl_data, load_ensembl_jsonfile
+from .ensembl import download_ensembl_data, read_ensembl_jsonfile, insert_ensembl_data
 from .nextprot import download_nextprot_map_files, load_nextprot_accessions
-# from .uniprot import download_uniprot_data, load_uniprot_table
+from .uniprot import load_uniprot_data
+from .profiling import BuildProfiler, format_build_report
 
 
 
@@ -47,40 +49,148 @@ def create_sqlite_database(sqlite_file):
     conn.close()
 
 
-def deprecate_trembl_accessions(sqlite_file):
+def _demote_trembl_accessions(c, taxon):
     # This is special handling for Uniprot accessions, which are split between "SwissProt" and "TrEMBL" based on
-    # whether they're reviewed. When a SwissProt accession exists for a given gene, it's generally better to
-    # use that. So, here we're marking all TrEMBL accessions for genes with a SwissProt accession as non-canonical.
-
-    conn = sqlite3.connect(sqlite_file)
-    c = conn.cursor()
+    # whether they're reviewed. When a SwissProt accession exists for a given proteoform, it's generally better to
+    # use that. So, here we're marking all TrEMBL accessions for proteoforms with a SwissProt accession as non-canonical,
+    # along with any Uniprot gene-level entries that refer to those TrEMBL accessions.
+    c.execute("""
+              UPDATE uniprot_trembl
+              SET is_canonical = 0
+              WHERE taxon = ? AND entity_index IN (
+                  SELECT entity_index FROM uniprot_swissprot WHERE taxon = ?
+              )
+              """, (taxon, taxon))
+    demoted = c.rowcount
     c.execute("""
               UPDATE uniprot_gene
               SET is_canonical = 0
-              WHERE identifier IN (
-                  SELECT uniprot_trembl.identifier
-                  FROM uniprot_trembl 
-                  INNER JOIN uniprot_swissprot
-                  WHERE uniprot_trembl.entity_index = uniprot_swissprot.entity_index
+              WHERE taxon = ? AND identifier IN (
+                  SELECT identifier FROM uniprot_trembl WHERE taxon = ? AND is_canonical = 0
               )
-              """)
+              """, (taxon, taxon))
+    return demoted + c.rowcount, 0
+
+
+def _demote_versioned_accessions(c, taxon):
+    # Where an entity carries both 'NM_001278' and 'NM_001278.3', the unversioned form is the one to report.
+    demoted = 0
+    for acc_table in VERSIONED_COLS:
+        c.execute(f"""
+                  UPDATE {acc_table}
+                  SET is_canonical = 0
+                  WHERE taxon = ? AND is_canonical = 1 AND instr(identifier, '.') > 0
+                  AND EXISTS (
+                      SELECT 1 FROM {acc_table} AS unversioned
+                      WHERE unversioned.taxon = {acc_table}.taxon
+                      AND unversioned.entity_index = {acc_table}.entity_index
+                      AND unversioned.identifier = substr({acc_table}.identifier, 1, instr({acc_table}.identifier, '.') - 1)
+                  )
+                  """, (taxon,))
+        demoted += c.rowcount
+    return demoted, 0
+
+
+def _demote_gene_synonyms(c, taxon):
+    # Resolves gene names against Uniprot's primary gene name (loaded by load_uniprot_data from SwissProt entries).
+    # Only genes with exactly one primary name are resolved: a primary name that was loaded as a synonym is made
+    # canonical, and any other canonical name on the gene becomes non-canonical. Without Uniprot data there is
+    # nothing to resolve against.
+    c.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = ?", (UNIPROT_PRIMARY_NAME_TABLE,))
+    if not c.fetchone()[0]:
+        return 0, 0
+    single_primary = f"""(SELECT entity_index FROM {UNIPROT_PRIMARY_NAME_TABLE} WHERE taxon = ?
+                          GROUP BY entity_index HAVING COUNT(*) = 1)"""
+    c.execute(f"""
+              UPDATE gene_name
+              SET is_canonical = 1
+              WHERE taxon = ? AND is_canonical = 0
+              AND entity_index IN {single_primary}
+              AND EXISTS (
+                  SELECT 1 FROM {UNIPROT_PRIMARY_NAME_TABLE} AS p
+                  WHERE p.taxon = gene_name.taxon AND p.entity_index = gene_name.entity_index
+                  AND p.identifier = gene_name.identifier
+              )
+              """, (taxon, taxon))
+    promoted = c.rowcount
+    c.execute(f"""
+              UPDATE gene_name
+              SET is_canonical = 0
+              WHERE taxon = ? AND is_canonical = 1
+              AND entity_index IN {single_primary}
+              AND NOT EXISTS (
+                  SELECT 1 FROM {UNIPROT_PRIMARY_NAME_TABLE} AS p
+                  WHERE p.taxon = gene_name.taxon AND p.entity_index = gene_name.entity_index
+                  AND p.identifier = gene_name.identifier
+              )
+              """, (taxon, taxon))
+    return c.rowcount, promoted
+
+
+def resolve_canonical_accessions(sqlite_file, progress = print):
+    # Each pass is a single UPDATE per taxon, driven by the (taxon, entity_index) indexes built by build_indexes(),
+    # so this should be run after indexing. Each pass returns (demoted, promoted) row counts. Returns the number of
+    # rows changed.
+    conn = sqlite3.connect(sqlite_file)
+    c = conn.cursor()
+
+    c.execute("SELECT taxon FROM species_table")
+    taxa = [x[0] for x in c.fetchall()]
+    for taxon in taxa:
+        for pass_name, canonical_pass in [('TrEMBL', _demote_trembl_accessions),
+                                          ('versioned', _demote_versioned_accessions),
+                                          ('gene synonym', _demote_gene_synonyms)]:
+            start = time.time()
+            demoted, promoted = canonical_pass(c, taxon)
+            conn.commit()
+            promoted_note = f", {promoted} canonical" if promoted else ""
+            progress(f"Taxon {taxon}: marked {demoted} {pass_name} accessions non-canonical{promoted_note} ({time.time() - start:.1f}s)")
+
+    changed = conn.total_changes
+    conn.close()
+    return changed
+
+
+def build_canonical_views(sqlite_file, progress = print):
+    # require_canonical queries join against these instead of filtering each identifier table in the WHERE clause;
+    # the partial indexes mean the views cost nothing on disk beyond the canonical rows themselves.
+    conn = sqlite3.connect(sqlite_file)
+    c = conn.cursor()
+
+    for acc_table in GENE_COLS + ISOFORM_COLS + PROTEOFORM_COLS:
+        view_name = acc_table + CANONICAL_VIEW_SUFFIX
+        c.execute(f"CREATE INDEX IF NOT EXISTS {view_name}_entity_index ON {acc_table} (taxon, entity_index) WHERE is_canonical = 1")
+        c.execute(f"CREATE INDEX IF NOT EXISTS {view_name}_identifier_index ON {acc_table} (identifier) WHERE is_canonical = 1")
+        c.execute(f"DROP VIEW IF EXISTS {view_name}")
+        c.execute(f"CREATE VIEW {view_name} AS SELECT * FROM {acc_table} WHERE is_canonical = 1")
+
     conn.commit()
     conn.close()
+    progress("Built canonical views")
+    return 0
+
 
-def remove_redundancies(sqlite_file):
+def remove_redundancies(sqlite_file, progress = print):
     conn = sqlite3.connect(sqlite_file)
     c = conn.cursor()
 
+    c.execute("SELECT COUNT(*) FROM identifier_directory")
+    before_dedup = c.fetchone()[0]
+
     c.execute("DROP TABLE IF EXISTS dedup_directory")
     c.execute("CREATE TABLE dedup_directory AS SELECT * FROM identifier_directory GROUP BY identifier, identifier_type")
     c.execute("DROP TABLE identifier_directory")
     c.execute("ALTER TABLE dedup_directory RENAME TO identifier_directory")
+    c.execute("SELECT COUNT(*) FROM identifier_directory")
+    after_dedup = c.fetchone()[0]
 
     conn.commit()
     conn.close()
+    progress(f"Removed {before_dedup - after_dedup} redundant identifier directory rows")
+    return after_dedup
 
 
-def build_indexes(sqlite_file):
+def build_indexes(sqlite_file, progress = print):
     conn = sqlite3.connect(sqlite_file)
     c = conn.cursor()
     
@@ -90,14 +200,69 @@ def build_indexes(sqlite_file):
 
     for acc_table in GENE_COLS + ISOFORM_COLS + PROTEOFORM_COLS:
         c.execute(f"CREATE INDEX IF NOT EXISTS {acc_table}_entity_index ON {acc_table} (entity_index)")
-        print(acc_table)
+        c.execute(f"CREATE INDEX IF NOT EXISTS {acc_table}_taxon_entity_index ON {acc_table} (taxon, entity_index)")
+        c.execute(f"CREATE INDEX IF NOT EXISTS {acc_table}_identifier_index ON {acc_table} (identifier)")
+        progress(acc_table)
+
+    conn.commit()
+    conn.close()
+    progress("Built indexes")
+    return 0
+
+
+def build_normalized_keys(sqlite_file, progress = print):
+    # Adds a 'normalized' lookup column (see normalize_identifier) to every identifier table and to the directory,
+    # so that match='normalized' queries are plain indexed equality lookups. Safe to run on an existing database.
+    conn = sqlite3.connect(sqlite_file)
+    conn.create_function('accessive_normalize', 2, normalize_identifier, deterministic=True)
+    c = conn.cursor()
+
+    for acc_table in GENE_COLS + ISOFORM_COLS + PROTEOFORM_COLS + ['identifier_directory']:
+        c.execute(f"PRAGMA table_info({acc_table})")
+        if 'normalized' not in [x[1] for x in c.fetchall()]:
+            c.execute(f"ALTER TABLE {acc_table} ADD COLUMN normalized TEXT")
+        type_expr = 'identifier_type' if acc_table == 'identifier_directory' else f"'{acc_table}'"
+        c.execute(f"UPDATE {acc_table} SET normalized = accessive_normalize(identifier, {type_expr})")
+        c.execute(f"CREATE INDEX IF NOT EXISTS {acc_table}_normalized_index ON {acc_table} (normalized)")
+        conn.commit()
+
+    changed = conn.total_changes
+    conn.close()
+    progress("Built normalized keys")
+    return changed
+
+
+def build_text_search_index(sqlite_file, progress = print):
+    # FTS5 index over gene names and descriptions. The taxon is stored as an indexed token so searches can be
+    # restricted to one species inside the full-text match itself.
+    conn = sqlite3.connect(sqlite_file)
+    c = conn.cursor()
+
+    c.execute(f"DROP TABLE IF EXISTS {TEXT_SEARCH_TABLE}")
+    c.execute(f"CREATE VIRTUAL TABLE {TEXT_SEARCH_TABLE} USING fts5(text, taxon, identifier_type UNINDEXED, entity_index UNINDEXED)")
+    for acc_table in TEXT_SEARCH_COLS:
+        c.execute(f"""INSERT INTO {TEXT_SEARCH_TABLE} (text, taxon, identifier_type, entity_index)
+                      SELECT identifier, taxon, '{acc_table}', entity_index FROM {acc_table}""")
+    c.execute(f"INSERT INTO {TEXT_SEARCH_TABLE} ({TEXT_SEARCH_TABLE}) VALUES ('optimize')")
 
     conn.commit()
+    changed = conn.total_changes
     conn.close()
-    print("Built indexes")
+    progress("Built text search index")
+    return changed
+
 
+def compile_full_database(sqlite_file = None, include_list=None, cache_dir=None, include_uniprot=False,
+                          progress = print, trace_memory = False):
+    """
+    Downloads all source data and builds a complete Accessive database. Each stage is timed by a BuildProfiler, and
+    the resulting build report (per-stage wall time, rows written, peak memory and database size) is stored in the
+    database's accessive_meta table under 'build_report', as well as being returned.
 
-def compile_full_database(sqlite_file = None, include_list=None, cache_dir=None):
+    Parameters:
+    - progress (callable, optional): Called with each progress message; defaults to print.
+    - trace_memory (bool, optional): Record per-stage peak Python heap usage with tracemalloc (slows the build down).
+    """
     if sqlite_file is None:
         sqlite_file = DATABASE_FILE
         if not os.path.exists(os.path.dirname(sqlite_file)):
@@ -107,33 +272,72 @@ def compile_full_database(sqlite_file = None, include_list=None, cache_dir=None)
 
     assert(os.path.exists(cache_dir))
     assert(not os.path.exists(sqlite_file)), "Database file already exists: %s" % sqlite_file
+    profiler = BuildProfiler(sqlite_file, progress, trace_memory)
   
-    print("Initializing database...")
-    create_sqlite_database(sqlite_file)   
-
-    print("Downloading and loading Ensembl data...")
-    for data_buffer in download_ensembl_data(include_list, [], cache_dir):
-        load_ensembl_jsonfile(data_buffer, sqlite_file)
+    progress("Initializing database...")
+    with profiler.stage('create'):
+        create_sqlite_database(sqlite_file)   
+
+    # Downloads run in the background while earlier species load, so 'ensembl_download' is only the time spent
+    # waiting for the next file.
+    progress("Downloading and loading Ensembl data...")
+    downloads = download_ensembl_data(include_list, [], cache_dir, progress=progress)
+    while True:
+        with profiler.stage('ensembl_download'):
+            data_buffer = next(downloads, None)
+        if data_buffer is None:
+            break
+        with profiler.stage('ensembl_parse'):
+            data = read_ensembl_jsonfile(data_buffer)
         del data_buffer
-
-    print("Downloading and loading Nextprot data...")
-    nextprot_ensts, nextprot_ensgs = download_nextprot_map_files(cache_dir)
-    load_nextprot_accessions(nextprot_ensts, nextprot_ensgs, sqlite_file)
+        with profiler.stage('ensembl_insert') as stage:
+            stage['rows'] += insert_ensembl_data(data, sqlite_file, progress)
+        del data
+
+    progress("Downloading and loading Nextprot data...")
+    with profiler.stage('nextprot_download'):
+        nextprot_ensts, nextprot_ensgs = download_nextprot_map_files(cache_dir)
+    with profiler.stage('nextprot_load') as stage:
+        stage['rows'] += load_nextprot_accessions(nextprot_ensts, nextprot_ensgs, sqlite_file, progress)
    
-    print("Adjusting canonical accession designations...")
-    deprecate_trembl_accessions(DATABASE_FILE)
-    print("Removing redundant rows...")
-    remove_redundancies(DATABASE_FILE)
-    print("Building indexes...")
-    build_indexes(DATABASE_FILE)
-
-    print("Vacuuming database...")
-    conn = sqlite3.connect(DATABASE_FILE)
-    conn.execute("VACUUM")
-    conn.commit()
-    conn.close()
-
-    print("Done")
+    progress("Building indexes...")
+    with profiler.stage('indexes'):
+        build_indexes(sqlite_file, progress)
+
+    if include_uniprot:
+        progress("Downloading and loading Uniprot data...")
+        conn = sqlite3.connect(sqlite_file)
+        taxa = [x[0] for x in conn.execute("SELECT taxon FROM species_table")]
+        conn.close()
+        with profiler.stage('uniprot') as stage:
+            stage['rows'] += load_uniprot_data(sqlite_file, taxa, progress=progress)
+
+    progress("Removing redundant rows...")
+    with profiler.stage('remove_redundancies') as stage:
+        stage['rows'] += remove_redundancies(sqlite_file, progress)
+    progress("Adjusting canonical accession designations...")
+    with profiler.stage('canonical_accessions') as stage:
+        stage['rows'] += resolve_canonical_accessions(sqlite_file, progress)
+    with profiler.stage('canonical_views'):
+        build_canonical_views(sqlite_file, progress)
+    progress("Building normalized lookup keys...")
+    with profiler.stage('normalized_keys') as stage:
+        stage['rows'] += build_normalized_keys(sqlite_file, progress)
+    progress("Building text search index...")
+    with profiler.stage('text_search') as stage:
+        stage['rows'] += build_text_search_index(sqlite_file, progress)
+
+    progress("Vacuuming database...")
+    with profiler.stage('vacuum'):
+        conn = sqlite3.connect(sqlite_file)
+        conn.execute("VACUUM")
+        conn.commit()
+        conn.close()
+
+    build_report = profiler.save()
+    progress(format_build_report(build_report))
+    progress("Done")
+    return build_report
 
 
 if __name__ == '__main__':
@@ -1,9 +1,13 @@
 import sqlite3
 import json
-from ftplib import FTP
+from ftplib import FTP, error_perm, error_temp, error_reply
 import os
 import gzip
-import io
+import zlib
+import shutil
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from ..data_structure import *
 
@@ -19,52 +23,175 @@ ENSEMBL_PROTEOFORM_COLS = [('ensembl_prot', 'id'), ('uniparc', 'UniParc'), ('alp
 
 
 
-def download_ensembl_data(include_list=None, already_loaded = [], data_save_dir = None):
+ENSEMBL_FTP_HOST = 'ftp.ensembl.org'
+ENSEMBL_JSON_DIR = 'pub/current_json'
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_RETRIES = 5
+CHECKSUM_RETRIES = 1 # Full re-downloads after a checksum mismatch, before giving up on a species
+DOWNLOAD_TIMEOUT = 120
+VERIFIED_SUFFIX = '.verified' # Marks a cache file as complete; files are only ever given this once checked
+
+
+def _connect(host, port, *directories):
+    ftp = FTP(timeout=DOWNLOAD_TIMEOUT)
+    ftp.connect(host, port)
+    ftp.login()
+    for directory in directories:
+        ftp.cwd(directory)
+    return ftp
+
+
+def _bsd_checksum(file_name):
+    # The 'sum' (BSD algorithm) checksum Ensembl publishes in each directory's CHECKSUMS file, as (checksum, 1K blocks).
+    # The algorithm is a byte-at-a-time rotate-and-add, far too slow in pure Python for multi-GB files, so this relies
+    # on the system 'sum' and returns None if it can't be run.
+    out = subprocess.run(['sum', '-r', file_name], capture_output=True, text=True)
+    if out.returncode != 0:
+        return None
+    checksum, blocks = out.stdout.split()[:2]
+    return int(checksum), int(blocks)
+
+
+def _remote_checksums(ftp):
+    lines = []
+    try:
+        ftp.retrlines('RETR CHECKSUMS', lines.append)
+    except error_perm:
+        return {}
+    checksums = {}
+    for line in lines:
+        fields = line.split()
+        if len(fields) == 3:
+            checksums[fields[2]] = (int(fields[0]), int(fields[1]))
+    return checksums
+
+
+def _gzip_is_complete(file_name):
+    try:
+        with gzip.open(file_name, 'rb') as f:
+            while f.read(1 << 24):
+                pass
+        return True
+    except (EOFError, OSError, zlib.error):
+        return False
+
+
+def _fetch_species(dir_name, data_save_dir, host, port, json_dir, verify_checksums, progress = print):
+    # Runs in a worker thread with its own FTP connection. Downloads go to a '.part' file that later attempts resume
+    # with REST; the gzipped cache file only appears, via an atomic rename, once the download has been verified.
+    with _connect(host, port, json_dir, dir_name) as ftp:
+        item = next((x for x in ftp.nlst() if x.endswith('.json')), None)
+        if item is None:
+            progress(f"No JSON file found for {dir_name}.")
+            return None
+        cache_file = os.path.join(data_save_dir, item)+'.gz'
+        if os.path.exists(cache_file):
+            if os.path.exists(cache_file + VERIFIED_SUFFIX) or _gzip_is_complete(cache_file):
+                open(cache_file + VERIFIED_SUFFIX, 'w').close()
+                progress('Cached: %s' % cache_file)
+                return cache_file
+            progress('Discarding incomplete cache file: %s' % cache_file)
+            os.remove(cache_file)
+        ftp.voidcmd('TYPE I')
+        try:
+            remote_size = ftp.size(item)
+        except error_perm:
+            remote_size = None
+        checksums = _remote_checksums(ftp) if verify_checksums else {}
+
+    part_file = os.path.join(data_save_dir, item)+'.part'
+    if remote_size is None:
+        progress(f"WARNING: The server did not report the size of {item}, so it can't be resumed or checked for completeness.")
+    for checksum_attempt in range(CHECKSUM_RETRIES + 1):
+        for attempt in range(DOWNLOAD_RETRIES):
+            offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+            if offset and (remote_size is None or offset > remote_size):
+                # Without a remote size a partial file can't be resumed safely, so every attempt starts over
+                os.remove(part_file)
+                offset = 0
+            if remote_size is None or offset < remote_size:
+                progress(("Resuming %s at byte %d" % (item, offset)) if offset else ("Downloading " + item))
+                try:
+                    with _connect(host, port, json_dir, dir_name) as ftp, open(part_file, 'ab') as data:
+                        ftp.retrbinary('RETR ' + item, data.write, rest=offset or None)
+                except error_perm as err:
+                    if offset and str(err).startswith('5'):
+                        progress(f"Server refused to resume {item} ({err}); restarting download.")
+                        os.remove(part_file)
+                    else:
+                        raise
+                    continue
+                except (OSError, EOFError, error_temp, error_reply) as err:
+                    progress(f"Download of {item} interrupted ({err}); retrying.")
+                    continue
+            if remote_size is None or os.path.getsize(part_file) == remote_size:
+                break
+        else:
+            raise RuntimeError(f"Could not download {item} after {DOWNLOAD_RETRIES} attempts.")
+
+        if item not in checksums:
+            break
+        local_checksum = _bsd_checksum(part_file)
+        if local_checksum is None:
+            progress(f"WARNING: Could not run 'sum' to checksum {item}; using it unverified.")
+            break
+        if local_checksum == checksums[item]:
+            break
+        # A resumed download can splice together two different versions of the file, so start again from scratch
+        os.remove(part_file)
+        if checksum_attempt < CHECKSUM_RETRIES:
+            progress(f"Checksum mismatch for {item}; downloading it again.")
+    else:
+        raise RuntimeError(f"Checksum mismatch for {item} after {CHECKSUM_RETRIES + 1} downloads; the download has been removed, so re-running will fetch it again.")
+
+    with open(part_file, 'rb') as raw, gzip.open(cache_file + '.tmp', 'wb') as compressed:
+        shutil.copyfileobj(raw, compressed, 1 << 20)
+    os.replace(cache_file + '.tmp', cache_file)
+    open(cache_file + VERIFIED_SUFFIX, 'w').close()
+    os.remove(part_file)
+    progress("Downloaded " + item)
+    return cache_file
+
+
+def download_ensembl_data(include_list=None, already_loaded = [], data_save_dir = None, max_workers = DOWNLOAD_WORKERS,
+                          host = ENSEMBL_FTP_HOST, port = 21, json_dir = ENSEMBL_JSON_DIR, verify_checksums = True,
+                          progress = print):
+    # Species are fetched in parallel, and each file is yielded as soon as it is ready (in completion order, not
+    # listing order), so loading one species overlaps with downloading the rest.
     if include_list is not None:
         include_list = [x[1] for x in include_list] # Only the scientific name strings, which match Ensembl's directory names
-    with FTP("ftp.ensembl.org") as ftp:
-        ftp.login()
-        ftp.cwd("pub/current_json")
+    if data_save_dir is None:
+        data_save_dir = tempfile.mkdtemp()
+
+    if verify_checksums and shutil.which('sum') is None:
+        progress("WARNING: The 'sum' command isn't available, so downloads will only be checked against their expected size.")
+        verify_checksums = False
+
+    species = []
+    with _connect(host, port, json_dir) as ftp:
         for dir_name in ftp.nlst():
-            print(dir_name)
+            progress(dir_name)
             if include_list is not None and dir_name not in include_list:
-                print(f"Skipping {dir_name} because it is not in the include list.")
+                progress(f"Skipping {dir_name} because it is not in the include list.")
                 continue
             elif dir_name in already_loaded:
-                print(f"Skipping {dir_name} because it is already loaded.")
+                progress(f"Skipping {dir_name} because it is already loaded.")
                 continue
-            ftp.cwd(dir_name)
-            for item in ftp.nlst():
-                if item.endswith('.json'):
-                    if data_save_dir:
-                        cache_file = os.path.join(data_save_dir, item)+'.gz'
-                        if os.path.exists(cache_file):
-                            print('Cached: %s' % cache_file)
-                            yield gzip.open(cache_file, 'rb')  
-                            break 
-                        else:
-                            print('Caching: %s' % cache_file)
-                            data = gzip.open(cache_file, 'wb')
-                    else:
-                        data = io.BytesIO()
-
-                    try:
-                        print("Downloading " + item)
-                        ftp.retrbinary('RETR ' + item, data.write)
-                    except ConnectionResetError:
-                        print("Connection reset error. Trying again.")
-                        ftp.retrbinary('RETR ' + item, data.write)
-
-                    if data_save_dir:
-                        data.close()
-                        data = gzip.open(os.path.join(data_save_dir, item)+'.gz', 'rb')  
-                    else:
-                        data.seek(0)
+            species.append(dir_name)
 
-                    print("Downloaded " + item)
-                    yield data 
-                    break
-            ftp.cwd('..')
+    # Not a 'with' block: if the consumer stops early (or a download fails), leaving the block would wait for every
+    # remaining download to finish, so pending downloads are cancelled instead.
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = [executor.submit(_fetch_species, dir_name, data_save_dir, host, port, json_dir, verify_checksums, progress)
+                   for dir_name in species]
+        for future in as_completed(futures):
+            cache_file = future.result()
+            if cache_file is not None:
+                with gzip.open(cache_file, 'rb') as data_buffer:
+                    yield data_buffer
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 
@@ -79,7 +206,7 @@ def _list_item(data, key):
         assert(isinstance(thing, str))
         return [thing]
 
-def load_ensembl_jsonfile(json_file, sqlite_file):
+def read_ensembl_jsonfile(json_file):
     if isinstance(json_file, str):
         try:
             data = json.load(open(json_file, 'r')) # NB this is typically very large!
@@ -88,7 +215,16 @@ def load_ensembl_jsonfile(json_file, sqlite_file):
             data = pickle.load(open(json_file, 'rb'))
     else:
         data = json.load(json_file)
+    return data
+
+
+def load_ensembl_jsonfile(json_file, sqlite_file, progress = print):
+    # Returns the number of rows inserted.
+    return insert_ensembl_data(read_ensembl_jsonfile(json_file), sqlite_file, progress)
+
 
+def insert_ensembl_data(data, sqlite_file, progress = print):
+    # Inserts a parsed Ensembl JSON dump; kept separate from the parse so the two can be timed apart.
     conn = sqlite3.connect(sqlite_file)
     c = conn.cursor()
 
@@ -140,11 +276,13 @@ def load_ensembl_jsonfile(json_file, sqlite_file):
         
         if gene_index % 1000 == 0:
             conn.commit()
-            print(f"Processed {gene_index} genes.")
+            progress(f"Processed {gene_index} genes.")
 
 
     conn.commit()
+    inserted = conn.total_changes
     conn.close()
-    print(f"Skipped {skipped_lrg} LRG genes.")
-    print(f"Finished loading {json_file}.")
+    progress(f"Skipped {skipped_lrg} LRG genes.")
+    progress(f"Finished loading {data['organism']['name']}.")
+    return inserted
 
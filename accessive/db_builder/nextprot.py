@@ -5,6 +5,7 @@ import gzip
 import io
 import pandas as pd
 import tempfile
+import time
 from ..data_structure import *
 
 def download_nextprot_map_files(cache_dir):
@@ -24,9 +25,11 @@ def download_nextprot_map_files(cache_dir):
     return enst_map_file, ensg_map_file
 
 
-def joined_table(conn, c, join_table, target_data, target_main_col, target_join_col, target_table_name):
+def joined_table(conn, c, join_table, target_data, target_main_col, target_join_col, target_table_name, progress = print):
     assert(all([x in target_data.columns for x in [target_main_col, target_join_col, 'taxon', 'is_canonical']]))
+    start = time.time()
     target_data.to_sql('temp_table', conn, if_exists='replace', index=False)
+    staged = time.time()
     c.execute(f"DROP TABLE IF EXISTS {target_table_name}")
     c.execute(f"CREATE TABLE {target_table_name} ({', '.join(IDENTIFIER_TABLE_COLS)})")
     cmd = f"""INSERT INTO {target_table_name} (entity_index, identifier, taxon, is_canonical) 
@@ -34,13 +37,17 @@ def joined_table(conn, c, join_table, target_data, target_main_col, target_join_
               FROM temp_table JOIN {join_table} ON temp_table.{target_join_col} = {join_table}.identifier
            """
     c.execute(cmd)
+    joined = c.rowcount
     conn.commit()
     c.execute("DROP TABLE temp_table")
     conn.commit()
+    progress(f"Loaded {joined} rows into {target_table_name} (to_sql {staged - start:.1f}s, join {time.time() - staged:.1f}s)")
+    return joined
 
 
 
-def load_nextprot_accessions(enst_map_file, ensg_map_file, sqlite_file):
+def load_nextprot_accessions(enst_map_file, ensg_map_file, sqlite_file, progress = print):
+    # Returns the number of Nextprot identifier rows written.
     ensgs = pd.read_csv(ensg_map_file, sep='\t', header=None, names=['nextprot', 'ensg'])
     ensts = pd.read_csv(enst_map_file, sep='\t', header=None, names=['nextprot', 'enst'])
 
@@ -51,12 +58,13 @@ def load_nextprot_accessions(enst_map_file, ensg_map_file, sqlite_file):
 
     conn = sqlite3.connect(sqlite_file)
     c = conn.cursor()
-    joined_table(conn, c, 'ensembl_gene', ensgs, 'nextprot', 'ensg', 'nextprot')
-    joined_table(conn, c, 'ensembl_mrna', ensts, 'nextprot', 'enst', 'nextprot_isoform')
+    written = joined_table(conn, c, 'ensembl_gene', ensgs, 'nextprot', 'ensg', 'nextprot', progress)
+    written += joined_table(conn, c, 'ensembl_mrna', ensts, 'nextprot', 'enst', 'nextprot_isoform', progress)
     c.execute("INSERT INTO metadata_table (identifier_type, entity_type) VALUES (?, ?)", ('nextprot', 'gene'))
     c.execute("INSERT INTO metadata_table (identifier_type, entity_type) VALUES (?, ?)", ('nextprot_isoform', 'mrna'))
     conn.commit()
     conn.close()
+    return written
 
 
 if __name__ == '__main__':
@@ -0,0 +1,146 @@
+import os
+import sys
+import time
+import json
+import sqlite3
+import datetime
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource # Not available on Windows, where peak RSS is simply not reported
+except ImportError:
+    resource = None
+
+
+BUILD_REPORT_KEY = 'build_report'
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS
+    return peak / (1024*1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _database_size_mb(sqlite_file):
+    size = 0
+    for path in [sqlite_file, sqlite_file + '-wal', sqlite_file + '-journal']:
+        if os.path.exists(path):
+            size += os.path.getsize(path)
+    return size / (1024*1024)
+
+
+class BuildProfiler(object):
+    """
+    Records per-stage statistics for a database build: wall time, rows written, rows/second, peak memory and database
+    size after the stage. Stages that run more than once (e.g. one load per species) are accumulated under one name.
+
+    Parameters:
+    - sqlite_file (str): Database being built; its size is recorded after each stage.
+    - progress (callable, optional): Called with a one-line message as each stage finishes. Defaults to print; pass
+    None to record silently.
+    - trace_memory (bool, optional): Also record the peak Python heap allocation for each stage with tracemalloc.
+    Off by default, since tracing slows down the Python-heavy stages (JSON parsing, row inserts) considerably.
+    """
+    def __init__(self, sqlite_file, progress = print, trace_memory = False):
+        self.sqlite_file = sqlite_file
+        self.progress = progress
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self.started = datetime.datetime.now().isoformat()
+        self._start = time.perf_counter()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager timing one stage. Yields the stage's record, so the body can add to record['rows'] (typically
+        the return value of a db_builder function, which is the number of rows it wrote).
+        """
+        record = self.stages.setdefault(name, {'name': name, 'calls': 0, 'seconds': 0.0, 'rows': 0,
+                                               'peak_rss_mb': None, 'peak_traced_mb': None})
+        rows_before = record['rows']
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            elapsed = time.perf_counter() - start
+            record['calls'] += 1
+            record['seconds'] += elapsed
+            record['rows_per_second'] = record['rows'] / record['seconds'] if record['rows'] and record['seconds'] else None
+            record['peak_rss_mb'] = _peak_rss_mb()
+            if self.trace_memory:
+                traced = tracemalloc.get_traced_memory()[1] / (1024*1024)
+                record['peak_traced_mb'] = max(traced, record['peak_traced_mb'] or 0)
+            record['database_mb'] = _database_size_mb(self.sqlite_file)
+            if self.progress is not None:
+                self.progress(f"[{name}] {elapsed:.1f}s, {record['rows'] - rows_before} rows, "
+                              f"database {record['database_mb']:.1f} MB")
+
+    def report(self):
+        return {'started': self.started,
+                'total_seconds': time.perf_counter() - self._start,
+                'peak_rss_mb': _peak_rss_mb(),
+                'database_mb': _database_size_mb(self.sqlite_file),
+                'stages': list(self.stages.values())}
+
+    def save(self):
+        """
+        Stores the build report as JSON in the database's accessive_meta table, replacing any earlier report,
+        and returns it.
+        """
+        if self.trace_memory:
+            tracemalloc.stop()
+        build_report = self.report()
+        conn = sqlite3.connect(self.sqlite_file)
+        conn.execute("DELETE FROM accessive_meta WHERE key = ?", (BUILD_REPORT_KEY,))
+        conn.execute("INSERT INTO accessive_meta (key, val) VALUES (?, ?)", (BUILD_REPORT_KEY, json.dumps(build_report)))
+        conn.commit()
+        conn.close()
+        return build_report
+
+
+def load_build_report(sqlite_file):
+    """
+    Returns the build report stored in a database by BuildProfiler.save(), or None if the database has none.
+    """
+    conn = sqlite3.connect(sqlite_file)
+    row = conn.execute("SELECT val FROM accessive_meta WHERE key = ?", (BUILD_REPORT_KEY,)).fetchone()
+    conn.close()
+    return json.loads(row[0]) if row else None
+
+
+def format_build_report(build_report):
+    """
+    Formats a build report as a fixed-width table, one line per stage, slowest first.
+    """
+    def fmt(value, spec):
+        return format(value, spec) if value is not None else '-'
+
+    lines = [f"{'stage':<28}{'calls':>6}{'seconds':>10}{'rows':>12}{'rows/s':>11}{'RSS MB':>9}{'heap MB':>9}{'DB MB':>9}"]
+    for record in sorted(build_report['stages'], key=lambda x: -x['seconds']):
+        lines.append(f"{record['name']:<28}{record['calls']:>6}{record['seconds']:>10.1f}{record['rows']:>12}"
+                     f"{fmt(record.get('rows_per_second'), '.0f'):>11}{fmt(record['peak_rss_mb'], '.0f'):>9}"
+                     f"{fmt(record['peak_traced_mb'], '.0f'):>9}{fmt(record.get('database_mb'), '.1f'):>9}")
+    lines.append(f"Total {build_report['total_seconds']:.1f}s, peak RSS {fmt(build_report['peak_rss_mb'], '.0f')} MB, "
+                 f"database {build_report['database_mb']:.1f} MB")
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Show the build report stored in an Accessive database")
+    parser.add_argument('database', help='Database file')
+    args = parser.parse_args()
+
+    build_report = load_build_report(args.database)
+    if build_report is None:
+        print("No build report found in %s" % args.database)
+    else:
+        print(format_build_report(build_report))
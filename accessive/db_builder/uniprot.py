@@ -1,96 +1,207 @@
 import sqlite3
 import requests
-import gzip
-import io
-import pandas as pd
+import zlib
 import time
 
-from ..data_structure import * 
-
-# This takes awhile!
-def download_uniprot_table(taxons):
-    print("Downloading Uniprot table")
-    pages = []
-    res = requests.get('https://rest.uniprot.org/uniprotkb/search',
-                       params = {'compressed': "true",
-                                 'fields': ['accession', 'reviewed', 'organism_name', 'id', 'protein_name', 'gene_names', 'gene_oln', 
-                                            'gene_primary', 'gene_synonym', 'xref_refseq', 'xref_ccds', 'xref_embl', 'xref_ensembl', 'xref_geneid',
-                                            'organism_id'],
-                                 'format': 'tsv',
-                                 'query': '( ' + ' OR '.join(['(model_organism:%d)' % x for x in taxons]) + ' )',
-                                 'size': 500})
-    pages.append(gzip.decompress(res.content).decode('utf-8'))
-    next_link = res.headers['Link'].split(';')[0].strip('<>')
-    while next_link:
-        try:
-            res = requests.get(next_link)
-        except:
-            try:
-                print("Failed to get next link, retrying in 30 seconds")
-                time.sleep(30)
-                res = requests.get(next_link)
-            except:
-                print("Failed to get next link")
-                break
-        pages.append(gzip.decompress(res.content).decode('utf-8'))
-        assert(len(pages[-1]))
+from ..data_structure import *
+
+
+UNIPROT_SEARCH_URL = 'https://rest.uniprot.org/uniprotkb/search'
+UNIPROT_PAGE_SIZE = 500
+UNIPROT_RETRIES = 3
+UNIPROT_RETRY_WAIT = 30
+UNIPROT_TIMEOUT = (30, 300) # (connect, read) seconds; a stalled response raises requests.Timeout and is retried
+UNIPROT_PROGRESS_PAGES = 20 # Staged row count is reported every this many pages
+
+# All of these are [(name_in_accessive, field_in_uniprot_query, column_in_uniprot_tsv, separator, is_canonical)]
+UNIPROT_XREF_COLS = [('gene_name', 'gene_synonym', 'Gene Names (synonym)', ' ', 0),
+                     ('refseq_peptide', 'xref_refseq', 'RefSeq', ';', 1),
+                     ('ccds', 'xref_ccds', 'CCDS', ';', 1),
+                     ('embl', 'xref_embl', 'EMBL', ';', 1),
+                     ('entrez_gene', 'xref_geneid', 'GeneID', ';', 1)]
+# Primary gene names are staged under their own type and kept in UNIPROT_PRIMARY_NAME_TABLE, as well as being added
+# to gene_name, so that the canonical resolution stage can tell them apart from synonyms.
+UNIPROT_PRIMARY_NAME_COL = ('gene_primary', 'gene_primary', 'Gene Names (primary)', ';', 1)
+
+STAGING_TABLE_COLS = ['accession TEXT', 'identifier_type TEXT', 'identifier TEXT', 'taxon INTEGER', 'is_canonical INTEGER']
+
+
+def _split_field(value, sep):
+    # Xref fields look like 'NP_001265.1 [P00750-1];NP_000921.1;', so only the first token of each entry is kept.
+    items = []
+    for entry in value.split(sep):
+        entry = entry.split()
+        if entry:
+            items.append(entry[0])
+    return items
+
+
+def _iter_page_lines(res, chunk_size = 1 << 16):
+    # Pages are requested gzip-compressed; decompress and split them chunk by chunk rather than holding the whole body.
+    decomp = None
+    remainder = b''
+    for chunk in res.iter_content(chunk_size):
+        if decomp is None:
+            decomp = zlib.decompressobj(zlib.MAX_WBITS | 32) if chunk[:2] == b'\x1f\x8b' else False
+        data = remainder + (decomp.decompress(chunk) if decomp else chunk)
+        lines = data.split(b'\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8')
+    if decomp:
+        remainder += decomp.flush()
+    if remainder:
+        yield remainder.decode('utf-8')
+
+
+def _fetch_page(session, url, params = None, retries = UNIPROT_RETRIES, retry_wait = UNIPROT_RETRY_WAIT, progress = print):
+    # A page is parsed in full before anything is inserted, so a connection dropped mid-page can be retried
+    # without leaving partial rows behind.
+    for attempt in range(retries + 1):
         try:
-            next_link = res.headers['Link'].split(';')[0].strip('<>')
-        except KeyError:
-            next_link = None
-        print('.', sep='', end='', flush=True)
-
-    print("Done")
-
-    table_name = 'uniprot_table_full.tsv'
-    pd.concat(
-            [pd.read_csv(io.StringIO(page), sep='\t') for page in pages]
-    ).to_csv(table_name, sep='\t', index=False)
-
-    return table_name
-
-
-def add_to_table(conn, c, updating_identifier, joining_identifier, target_table, target_update_col, target_join_col):
-    c.execute(f"SELECT index, identifier FROM {updating_identifier}")
-    before_update = c.fetchall()
-    
-
-    target_table.to_sql('temp_table', conn, if_exists='replace', index=False)
+            res = session.get(url, params=params, stream=True, timeout=UNIPROT_TIMEOUT)
+            res.raise_for_status()
+            lines = _iter_page_lines(res)
+            header = next(lines).split('\t')
+            rows = [dict(zip(header, line.split('\t'))) for line in lines if line]
+            return rows, res.links.get('next', {}).get('url')
+        except (requests.RequestException, zlib.error, StopIteration) as err:
+            if attempt == retries:
+                raise
+            progress(f"Failed to get {url} ({err}), retrying in {retry_wait} seconds")
+            time.sleep(retry_wait)
+
+
+def iter_uniprot_pages(taxons, url = UNIPROT_SEARCH_URL, page_size = UNIPROT_PAGE_SIZE,
+                       retries = UNIPROT_RETRIES, retry_wait = UNIPROT_RETRY_WAIT, progress = print):
+    """
+    Yields the Uniprot search results for the given taxa one page at a time, as lists of {column: value} dicts,
+    following the 'Link' cursor from each response to the next.
+    """
+    session = requests.Session()
+    params = {'compressed': "true",
+              'fields': ','.join(['accession', 'organism_id'] + [x[1] for x in UNIPROT_XREF_COLS + [UNIPROT_PRIMARY_NAME_COL]]),
+              'format': 'tsv',
+              'query': '( ' + ' OR '.join(['(model_organism:%d)' % x for x in taxons]) + ' )',
+              'size': page_size}
+    next_link = url
+    while next_link:
+        rows, next_link = _fetch_page(session, next_link, params, retries, retry_wait, progress)
+        params = None # The cursor link carries the query parameters along with it
+        yield rows
+
+
+def _staging_rows(rows):
+    for row in rows:
+        accession, taxon = row['Entry'], int(row['Organism (ID)'])
+        for db_name, _, tsv_name, sep, is_canonical in UNIPROT_XREF_COLS + [UNIPROT_PRIMARY_NAME_COL]:
+            for item in _split_field(row.get(tsv_name, ''), sep):
+                yield (accession, db_name, item, taxon, is_canonical)
+
+
+def merge_uniprot_staging(conn, c, progress = print):
+    # Uniprot entries are proteoform-level, so each staged row is attached through the Swissprot/TrEMBL accession
+    # to whichever entity level its destination table lives at. Returns the number of rows inserted (staging rows
+    # aren't counted).
+    c.execute("CREATE INDEX IF NOT EXISTS uniprot_staging_accession_index ON uniprot_staging (accession, taxon)")
+    c.execute("CREATE INDEX IF NOT EXISTS prot_entity_index ON entity_table (prot_index)")
+    c.execute("SELECT identifier_type, entity_type FROM metadata_table")
+    entity_types = dict(c.fetchall())
+
+    written = 0
+    for db_name, _, _, _, _ in UNIPROT_XREF_COLS:
+        entity_col = f"{entity_types[db_name]}_index"
+        added = 0
+        for uniprot_table in ['uniprot_swissprot', 'uniprot_trembl']:
+            c.execute(f"""
+                INSERT INTO {db_name} (entity_index, identifier, taxon, is_canonical)
+                    SELECT DISTINCT et.{entity_col}, s.identifier, s.taxon, s.is_canonical
+                    FROM {uniprot_table} AS u
+                    JOIN uniprot_staging AS s ON s.accession = u.identifier AND s.taxon = u.taxon
+                    JOIN entity_table AS et ON et.prot_index = u.entity_index AND et.taxon = u.taxon
+                    WHERE s.identifier_type = ? AND et.{entity_col} IS NOT NULL
+                    AND NOT EXISTS (
+                        SELECT 1 FROM {db_name} AS existing
+                        WHERE existing.taxon = s.taxon AND existing.entity_index = et.{entity_col} AND existing.identifier = s.identifier
+                        )
+                      """, (db_name,))
+            added += c.rowcount
+
+        c.execute(f"""
+            INSERT INTO identifier_directory (identifier, identifier_type)
+                SELECT DISTINCT s.identifier, s.identifier_type FROM uniprot_staging AS s
+                WHERE s.identifier_type = ? AND EXISTS (SELECT 1 FROM {db_name} AS t WHERE t.identifier = s.identifier AND t.taxon = s.taxon)
+                  """, (db_name,))
+        written += added + c.rowcount
+        conn.commit()
+        progress(f"Added {added} new entries to {db_name}")
+
+    # Primary names are attached at gene level through the reviewed (SwissProt) accessions only; unreviewed TrEMBL
+    # entries aren't trusted to name a gene. Any that Ensembl didn't already supply are added to gene_name, as
+    # canonical only when the gene has a single primary name (several mean Uniprot itself doesn't settle it).
+    c.execute(f"DROP TABLE IF EXISTS {UNIPROT_PRIMARY_NAME_TABLE}")
+    c.execute(f"CREATE TABLE {UNIPROT_PRIMARY_NAME_TABLE} ({', '.join(IDENTIFIER_TABLE_COLS)})")
+    c.execute(f"""
+        INSERT INTO {UNIPROT_PRIMARY_NAME_TABLE} (entity_index, identifier, taxon, is_canonical)
+            SELECT DISTINCT et.gene_index, s.identifier, s.taxon, 1
+            FROM uniprot_swissprot AS u
+            JOIN uniprot_staging AS s ON s.accession = u.identifier AND s.taxon = u.taxon
+            JOIN entity_table AS et ON et.prot_index = u.entity_index AND et.taxon = u.taxon
+            WHERE s.identifier_type = 'gene_primary' AND et.gene_index IS NOT NULL
+              """)
+    written += c.rowcount
+    c.execute(f"CREATE INDEX {UNIPROT_PRIMARY_NAME_TABLE}_entity_index ON {UNIPROT_PRIMARY_NAME_TABLE} (taxon, entity_index)")
     c.execute(f"""
-        INSERT INTO {updating_identifier} ({', '.join(IDENTIFIER_TABLE_COLS)})
-            SELECT {joining_identifier}.index, temp_table.{target_update_col}, temp_table.taxon, temp_table.is_canonical
-            FROM temp_table
-            JOIN {joining_identifier} ON temp_table.{target_join_col} = {joining_identifier}.identifier
+        INSERT INTO gene_name (entity_index, identifier, taxon, is_canonical)
+            SELECT p.entity_index, p.identifier, p.taxon,
+                   (SELECT COUNT(*) FROM {UNIPROT_PRIMARY_NAME_TABLE} AS other
+                    WHERE other.taxon = p.taxon AND other.entity_index = p.entity_index) = 1
+            FROM {UNIPROT_PRIMARY_NAME_TABLE} AS p
             WHERE NOT EXISTS (
-                SELECT 1 FROM {updating_identifier} WHERE {updating_identifier}.identifier = temp_table.{target_update_col}
+                SELECT 1 FROM gene_name AS existing
+                WHERE existing.taxon = p.taxon AND existing.entity_index = p.entity_index AND existing.identifier = p.identifier
                 )
               """)
+    added = c.rowcount
+    c.execute(f"""
+        INSERT INTO identifier_directory (identifier, identifier_type)
+            SELECT DISTINCT identifier, 'gene_name' FROM {UNIPROT_PRIMARY_NAME_TABLE}
+              """)
+    written += added + c.rowcount
     conn.commit()
-    c.execute(f"DROP TABLE temp_table")
-    conn.commit()
-
-    c.execute(f"SELECT index, identifier FROM {updating_identifier}")
-    after_update = c.fetchall()
+    progress(f"Added {added} Uniprot primary gene names to gene_name")
+    return written
 
-    print(f"Added {len(after_update) - len(before_update)} new entries to {updating_identifier}")
-    print(f"From {len(set([x[1] for x in before_update]))} to {len(set([x[1] for x in after_update]))} unique entries (change of {len(set([x[1] for x in after_update])) - len(set([x[1] for x in before_update]))}"))
 
-
-
-
-def load_uniprot_table(sqlite_file, uniprot_file_name):
+def load_uniprot_data(sqlite_file, taxons, url = UNIPROT_SEARCH_URL, page_size = UNIPROT_PAGE_SIZE, progress = print):
+    """
+    Streams Uniprot synonym and cross-reference data for the given taxa into the database. Each page is inserted
+    into a staging table as it arrives, and the staged rows are joined to the identifier tables in one pass at the end.
+    Returns the number of rows written.
+    """
     conn = sqlite3.connect(sqlite_file)
     c = conn.cursor()
-
-    table = pd.read_csv(uniprot_file_name, sep='\t')
-    gene_synonym_tab = table.apply(axis=1, func=lambda x: [(x['Entry'], gn, x['Organism (ID)']) for gn in
-                                                            x['Gene Names (synonym)'].split()]
-                                                            if isinstance(x['Gene Names (synonym)'], str) else [])
-    gene_synonym_tab = pd.DataFrame(sum(gene_synonym_tab, []), columns=['uniport_gn', 'gene_name', 'taxon'])
-    gene_synonym_tab['is_canonical'] = 0
-    add_to_table(conn, c, 'gene_name', 'uniprot_gn', gene_synonym_tab, 'gene_name', 'uniport_gn')
+    c.execute("DROP TABLE IF EXISTS uniprot_staging")
+    c.execute(f"CREATE TABLE uniprot_staging ({', '.join(STAGING_TABLE_COLS)})")
+
+    progress("Downloading Uniprot table")
+    staged = 0
+    for page_num, rows in enumerate(iter_uniprot_pages(taxons, url=url, page_size=page_size, progress=progress), 1):
+        c.executemany("INSERT INTO uniprot_staging (accession, identifier_type, identifier, taxon, is_canonical) VALUES (?, ?, ?, ?, ?)",
+                      _staging_rows(rows))
+        staged += c.rowcount
+        conn.commit()
+        if page_num % UNIPROT_PROGRESS_PAGES == 0:
+            progress(f"Staged {staged} Uniprot rows ({page_num} pages)")
+    progress(f"Staged {staged} Uniprot rows")
+
+    written = merge_uniprot_staging(conn, c, progress)
+    c.execute("DROP TABLE uniprot_staging")
+    conn.commit()
+    conn.close()
+    return written
 
 
 
 # if __name__ == '__main__':
-#     download_uniprot_table([9606, 10090, 10116, 559292])
+#     load_uniprot_data('/data/biostuff/ensembl_data/accessive_standard.sqlite', [9606, 10090, 10116, 559292])
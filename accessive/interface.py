@@ -1,5 +1,13 @@
 import os
+import sys
+import json
 import sqlite3
+import functools
+import pathlib
+import threading
+from collections import Counter, deque
+from array import array
+import numpy as np
 import pandas as pd
 
 from .data_structure import *
@@ -14,28 +22,120 @@ PROTEOFORM_COLS = ['ensembl_prot', 'uniparc', 'alphafold', 'uniprot_swissprot',
 
 KNOWN_IDENTIFIERS = set(GENE_COLS + ISOFORM_COLS + PROTEOFORM_COLS)
 
+# How many recent map() calls (and identifiers from each) reload() replays to warm a new database before switching to it
+WARM_QUERY_COUNT = 32
+WARM_IDS_PER_QUERY = 100
+
+
+def _quote_search_terms(text):
+    # Each whitespace-separated word becomes an FTS5 string, so punctuation in gene symbols (HLA-A, NKX2-1) is matched
+    # literally instead of being read as query syntax. A trailing '*' is kept as a prefix search.
+    terms = []
+    for word in text.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if not word: # A bare '*' has nothing to match
+            continue
+        terms.append('"' + word.replace('"', '""') + '"' + ('*' if prefix else ''))
+    return ' '.join(terms)
+
+
+class _DatabaseSnapshot():
+    # One open database plus the optional features detected in it; reload() replaces these as a unit. The
+    # connection is shared between threads (reload() may open it from the watcher thread), so calls on it are
+    # serialized with the lock.
+    def __init__(self, sqlite_file):
+        if not os.path.exists(sqlite_file):
+            raise FileNotFoundError(f"Database file not found: {sqlite_file}")
+        self.sqlite_file = sqlite_file
+        self.conn = sqlite3.connect(pathlib.Path(sqlite_file).resolve().as_uri() + '?mode=ro', uri=True, check_same_thread=False)
+        self.c = self.conn.cursor()
+        self.lock = threading.RLock()
+
+        self.has_canonical_views = self._check_canonical_views()
+        self.has_normalized_keys = self._check_normalized_keys()
+        self.has_text_search = self._check_text_search()
+        self.pair_tables = self._load_pair_tables()
+
+
+    def get_version(self):
+        self.c.execute("SELECT val FROM accessive_meta WHERE key = 'database_version'")
+        return self.c.fetchone()[0]
+
+
+    def _check_canonical_views(self):
+        # Databases built before the canonical-resolution stage don't have these, so fall back to per-table predicates.
+        self.c.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'view' AND name LIKE ?", ('%' + CANONICAL_VIEW_SUFFIX,))
+        return self.c.fetchone()[0] > 0
+
+
+    def _check_normalized_keys(self):
+        self.c.execute("PRAGMA table_info(identifier_directory)")
+        return 'normalized' in [x[1] for x in self.c.fetchall()]
+
+
+    def _check_text_search(self):
+        self.c.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = ?", (TEXT_SEARCH_TABLE,))
+        return self.c.fetchone()[0] > 0
+
+
+    def _load_pair_tables(self):
+        self.c.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = ?", (PAIR_TABLE_DIRECTORY,))
+        if not self.c.fetchone()[0]:
+            return {}
+        self.c.execute(f"SELECT from_type, to_type, table_name FROM {PAIR_TABLE_DIRECTORY}")
+        return {(x[0], x[1]): x[2] for x in self.c.fetchall()}
+
+
+def _on_snapshot(method):
+    # Runs the whole call against the database that was current when it started, even if reload() swaps in
+    # another one part way through, with a cursor of its own. Calls from different threads on the same snapshot
+    # take turns, since they share its connection.
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if getattr(self._pinned, 'db', None) is not None:
+            return method(self, *args, **kwargs)
+        db = self._current_db
+        with db.lock:
+            self._pinned.db, self._pinned.c = db, db.conn.cursor()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._pinned.c.close()
+                self._pinned.db = self._pinned.c = None
+    return wrapper
+
+
 class Accessive():
     def __init__(self, sqlite_file = None, 
                  default_from_type = None,
                  default_to_types = None,
                  default_format = 'pandas', 
                  default_taxon = None, 
-                 default_require_canonical = False):
+                 default_require_canonical = False,
+                 log_queries = False,
+                 watch_interval = None):
         if sqlite_file is None:
             if not os.path.exists(DATABASE_FILE):
                 raise RuntimeError(f"Database file not found in default location: {DATABASE_FILE} . Download the database or specify a different file.")
             sqlite_file = DATABASE_FILE
-        self.conn = sqlite3.connect(sqlite_file)
-        self.c = self.conn.cursor()
+        self.sqlite_file = sqlite_file
+        self._pinned = threading.local()
+        self._reload_lock = threading.Lock()
+        self._watch_stop = None
+        self._current_db = _DatabaseSnapshot(sqlite_file)
 
         try:
-            database_ver = self._get_db_version()
+            database_ver = self._current_db.get_version()
             if database_ver != DATABASE_VERSION:
-                print(f"WARNING: Database version {database_ver} does not match expected version {DATABASE_VERSION}. It may be incompatible with this version of Accessive.")
-                print("You can download the correct database version by running the command 'python -m accessive.database_ops --download'")
+                print(f"WARNING: Database version {database_ver} does not match expected version {DATABASE_VERSION}. It may be incompatible with this version of Accessive.", file=sys.stderr)
+                print("You can download the correct database version by running the command 'python -m accessive.database_ops --download'", file=sys.stderr)
         except sqlite3.OperationalError:
-            print("WARNING: Database version not found. This may be an old version of the database that does not include version information.")
-            print("You can download the correct database version by running the command 'python -m accessive.database_ops --download'")
+            print("WARNING: Database version not found. This may be an old version of the database that does not include version information.", file=sys.stderr)
+            print("You can download the correct database version by running the command 'python -m accessive.database_ops --download'", file=sys.stderr)
+
+        self.query_log = Counter() if log_queries else None
+        self._recent_queries = deque(maxlen=WARM_QUERY_COUNT)
 
         self.default_from_type = default_from_type
         self.default_to_types = default_to_types
@@ -49,16 +149,150 @@ class Accessive():
         assert(self.default_taxon is None or isinstance(self.default_taxon, int)), "default_taxon must be an integer."
         assert(isinstance(self.default_require_canonical, bool)), "default_require_canonical must be a boolean."
 
+        if watch_interval is not None:
+            self.watch(watch_interval)
 
 
-    def _get_db_version(self):
-        self.c.execute("SELECT val FROM accessive_meta WHERE key = 'database_version'")
-        return self.c.fetchone()[0]
 
+    @property
+    def _db(self):
+        pinned = getattr(self._pinned, 'db', None)
+        return pinned if pinned is not None else self._current_db
+
+    @property
+    def conn(self):
+        return self._db.conn
+
+    @property
+    def c(self):
+        pinned = getattr(self._pinned, 'c', None)
+        return pinned if pinned is not None else self._db.c
+
+
+    def reload(self, sqlite_file = None):
+        """
+        Switches to a new database file (or re-opens the current one, if none is given) without interrupting use of
+        this instance. The new database is checked for a compatible version and warmed up by replaying recently
+        requested mappings before it replaces the old one; calls already in progress finish on the old database.
+
+        Parameters:
+        - sqlite_file (str, optional): The database file to switch to. Defaults to the file currently in use.
 
-    def _get_identifier_type(self, acc, allow_multiple = False):
-        self.c.execute("SELECT identifier_type FROM identifier_directory WHERE identifier = ?", (acc,))
-        types = list(set([x[0] for x in self.c.fetchall()]))
+        Raises:
+        - RuntimeError: If the new database is missing, unreadable or does not have the expected version; the current
+        database stays in use.
+        """
+        if sqlite_file is None:
+            sqlite_file = self.sqlite_file
+        with self._reload_lock:
+            new_db = None
+            try:
+                new_db = _DatabaseSnapshot(sqlite_file)
+                database_ver = new_db.get_version()
+            except (FileNotFoundError, sqlite3.OperationalError, sqlite3.DatabaseError, TypeError) as err:
+                if new_db is not None:
+                    new_db.conn.close()
+                raise RuntimeError(f"Could not open database {sqlite_file} ({err}); not switching to it.") from err
+            if database_ver != DATABASE_VERSION:
+                new_db.conn.close()
+                raise RuntimeError(f"Database {sqlite_file} has version {database_ver}, expected {DATABASE_VERSION}; not switching to it.")
+
+            previous = (getattr(self._pinned, 'db', None), getattr(self._pinned, 'c', None))
+            with new_db.lock:
+                self._pinned.db, self._pinned.c = new_db, new_db.c
+                try:
+                    for ids, from_type, to_types, taxon, require_canonical, match, extensive in list(self._recent_queries):
+                        try:
+                            self._query(list(ids), from_type, list(to_types), taxon, require_canonical, match, False, extensive)
+                        except Exception:
+                            pass # Warming is best-effort; a query that fails here will fail the same way when it's made for real
+                finally:
+                    self._pinned.db, self._pinned.c = previous
+
+            # The old connection is left for garbage collection, since in-flight calls may still be using it
+            self._current_db = new_db
+            self.sqlite_file = sqlite_file
+
+
+    def _file_signature(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+    def watch(self, interval = 5.0):
+        """
+        Starts a background thread that checks the database file every interval seconds and calls reload() when it
+        has been replaced or modified (and has stopped changing). Use stop_watching() to end it.
+        """
+        self.stop_watching()
+        stop = self._watch_stop = threading.Event()
+
+        def watch_loop():
+            last = self._file_signature(self.sqlite_file)
+            pending = None
+            while not stop.wait(interval):
+                signature = self._file_signature(self.sqlite_file)
+                if signature is None or signature == last:
+                    pending = None
+                elif signature != pending:
+                    pending = signature # Wait one more interval in case the file is still being written
+                else:
+                    try:
+                        self.reload(self.sqlite_file)
+                    except Exception as err:
+                        print(f"WARNING: Could not reload database {self.sqlite_file}: {err}", file=sys.stderr)
+                    last, pending = signature, None
+
+        threading.Thread(target=watch_loop, daemon=True).start()
+
+
+    def stop_watching(self):
+        if self._watch_stop is not None:
+            self._watch_stop.set()
+            self._watch_stop = None
+
+
+    def save_query_log(self, log_file):
+        """
+        Writes the (from_type, to_type, taxon) frequencies recorded by an instance created with log_queries=True to a
+        JSON file, adding to any counts already in that file. The file can be passed to
+        'python -m accessive.database_ops --build-pair-tables' to precompute the most frequent conversions.
+        """
+        assert(self.query_log is not None), "Query logging is not enabled; create the Accessive instance with log_queries=True."
+        counts = Counter()
+        if os.path.exists(log_file):
+            with open(log_file, 'r') as f:
+                for entry in json.load(f):
+                    counts[(entry['from_type'], entry['to_type'], entry['taxon'])] += entry['count']
+        counts.update(self.query_log)
+        with open(log_file, 'w') as f:
+            json.dump([{'from_type': k[0], 'to_type': k[1], 'taxon': k[2], 'count': v} for k, v in counts.most_common()], f, indent=1)
+        self.query_log.clear()
+
+
+    def _lookup_column(self, match):
+        if match == 'exact':
+            return 'identifier'
+        elif match == 'normalized':
+            if not self._db.has_normalized_keys:
+                raise RuntimeError("This database has no normalized lookup keys; match='normalized' requires a database built with accessive.db_builder.build.build_normalized_keys().")
+            return 'normalized'
+        else:
+            raise ValueError(f"match must be one of 'exact' or 'normalized', not {match}.")
+
+
+    def _get_identifier_type(self, acc, allow_multiple = False, match = 'exact'):
+        if self._lookup_column(match) == 'normalized':
+            # The key depends on the type being matched, so try each distinct form and keep the consistent hits
+            keys = list(set(normalize_identifier(acc, x) for x in KNOWN_IDENTIFIERS))
+            self.c.execute("SELECT identifier_type, normalized FROM identifier_directory WHERE normalized IN (%s)" % ','.join(['?']*len(keys)), keys)
+            types = list(set([x[0] for x in self.c.fetchall() if normalize_identifier(acc, x[0]) == x[1]]))
+        else:
+            self.c.execute("SELECT identifier_type FROM identifier_directory WHERE identifier = ?", (acc,))
+            types = list(set([x[0] for x in self.c.fetchall()]))
         if not allow_multiple:
             if len(types) > 1:
                 raise Exception(f"Identifier {acc} is associated with multiple types: {', '.join(types)}")
@@ -73,6 +307,7 @@ class Accessive():
         return dict(self.c.fetchall())
 
     
+    @_on_snapshot
     def identify_taxon(self, taxon):
         """
         Utility function to identify what species a taxon number in the database corresponds to.
@@ -81,19 +316,22 @@ class Accessive():
         return self.c.fetchone()
 
     
-    def identify(self, acc):
+    @_on_snapshot
+    def identify(self, acc, match = 'exact'):
         """
         Identifies the type(s) of an accession identifier.
 
         Parameters:
         - acc (str): The accession identifier to be identified.
+        - match (str, optional): 'exact' (default) or 'normalized', to ignore case and version/isoform suffixes.
 
         Returns:
         A list of strings representing the type(s) of the identifier, if any.
         """
-        return self._get_identifier_type(acc)
+        return self._get_identifier_type(acc, match=match)
 
 
+    @_on_snapshot
     def available_taxons(self):
         """
         Returns a list of all available taxa in the database.
@@ -107,57 +345,187 @@ class Accessive():
         return self.available_taxons()
 
 
-    def _query(self, accs, from_type, dest_types, taxon = None, require_canonical = False):
+    def _query(self, accs, from_type, dest_types, taxon = None, require_canonical = False, match = 'exact', compact = False,
+               extensive = True):
+        # A single conversion with a precomputed pair table can skip the entity join entirely. Pair tables only hold
+        # the requested source identifiers' own mappings, so extensive and multi-species lookups take the general path,
+        # as do requests that also ask for the source type (the general path keeps sources with no destination).
+        if (len(dest_types) == 1 and (from_type, dest_types[0]) in self._db.pair_tables
+                and not extensive and taxon is not None and match == 'exact'):
+            return self._query_pair_table(self._db.pair_tables[(from_type, dest_types[0])], accs, from_type, dest_types[0],
+                                          [from_type] + dest_types, taxon, require_canonical, compact)
+
         if from_type not in dest_types:
             dest_types = [from_type] + dest_types
 
+        lookup_col = self._lookup_column(match)
+        if lookup_col == 'normalized':
+            accs = list(set(normalize_identifier(x, from_type) for x in accs))
+
         type_meta = self._get_type_metadata(dest_types)
         assert(len(type_meta) == len(dest_types))
         
         if taxon is None:
-            self.c.execute(f"SELECT taxon, entity_index FROM {from_type} WHERE identifier IN (%s)" % ','.join(['?']*len(accs)), accs) 
-            taxon, entity_indices = zip(*self.c.fetchall())
+            self.c.execute(f"SELECT taxon, entity_index FROM {from_type} WHERE {lookup_col} IN (%s)" % ','.join(['?']*len(accs)), accs) 
+            found = self.c.fetchall()
+            if not found:
+                return self._result_frame([], dest_types, compact)
+            taxon, entity_indices = zip(*found)
             assert(len(set(taxon)) == 1), f"Multi-species lookup not currently supported (found taxons {', '.join(set(map(str, taxon)))}.) It is recommended to specify a taxon."
             taxon = taxon[0]
             entity_indices = list(entity_indices)
         else:
-            self.c.execute(f"SELECT entity_index FROM {from_type} WHERE taxon = ? AND identifier IN (%s)" % ','.join(['?']*len(accs)), [taxon]+accs)
+            self.c.execute(f"SELECT entity_index FROM {from_type} WHERE taxon = ? AND {lookup_col} IN (%s)" % ','.join(['?']*len(accs)), [taxon]+accs)
             entity_indices = [x[0] for x in self.c.fetchall()]
 
-        self.c.execute(f"SELECT gene_index, mrna_index, prot_index FROM entity_table WHERE taxon = ? AND {type_meta[from_type]}_index IN ({','.join(['?']*len(entity_indices))})", 
-                       [taxon]+entity_indices)
+        # Without extensive, only rows for the requested identifiers themselves are wanted, so siblings sharing
+        # the same gene or proteoform are filtered out in the join rather than fetched and discarded afterwards.
+        source_filter = None if extensive else (from_type, lookup_col, accs)
+        result_table = self._query_entities(taxon, type_meta[from_type], entity_indices, dest_types, type_meta, require_canonical, compact,
+                                            source_filter)
+        return result_table[dest_types]
+
+
+    def _query_pair_table(self, table_name, accs, from_type, to_type, dest_types, taxon, require_canonical, compact):
+        query = (f"SELECT from_identifier AS {from_type}, to_identifier AS {to_type} FROM {table_name} "
+                 f"WHERE taxon = ? AND from_identifier IN ({','.join(['?']*len(accs))})")
+        if require_canonical:
+            query += " AND is_canonical = 1"
+        self.c.execute(query, [taxon]+list(accs))
+        column_names = [from_type, to_type]
+        if compact:
+            result_table = self._fetch_categorical(column_names)
+        else:
+            result_table = self._result_frame(self.c.fetchall(), column_names)
+        return result_table[dest_types]
+
 
+    def _query_entities(self, taxon, entity_type, entity_indices, dest_types, type_meta, require_canonical = False, compact = False,
+                        source_filter = None):
+        # Fetches dest_types for a set of gene/mrna/prot entities in one joined query; the entity columns are
+        # returned alongside the requested types. source_filter, if given, is (type, column, values) and restricts
+        # that type's joined identifier to the given values.
         base_query = f"SELECT et.taxon, et.gene_index, et.mrna_index, et.prot_index"
 
         join_clauses = []
         select_columns = []
         column_names = ['taxon', 'gene_index', 'mrna_index', 'prot_index']
+        use_views = require_canonical and self._db.has_canonical_views
         for dest_type in dest_types:
             entity_col = f"{type_meta[dest_type]}_index"
-            join_clause = f"LEFT JOIN {dest_type} ON et.{entity_col} = {dest_type}.entity_index AND et.taxon = {dest_type}.taxon"
+            dest_table = dest_type + CANONICAL_VIEW_SUFFIX if use_views else dest_type
+            join_clause = f"LEFT JOIN {dest_table} AS {dest_type} ON et.{entity_col} = {dest_type}.entity_index AND et.taxon = {dest_type}.taxon"
+            if require_canonical and not use_views:
+                # Same result as joining the view: a non-canonical identifier leaves an empty cell rather than dropping the row
+                join_clause += f" AND {dest_type}.is_canonical = 1"
             join_clauses.append(join_clause)
             select_columns.append(f"{dest_type}.identifier AS {dest_type}_identifier")
             column_names.append(dest_type)
 
         final_query = base_query + ", " + ", ".join(select_columns) + " FROM entity_table et " + " ".join(join_clauses)
 
-        final_query += f" WHERE et.taxon = ? AND et.{type_meta[from_type]}_index IN ({','.join(['?']*len(entity_indices))})"
+        final_query += f" WHERE et.taxon = ? AND et.{entity_type}_index IN ({','.join(['?']*len(entity_indices))})"
+        params = [taxon]+entity_indices
+
+        if source_filter is not None:
+            source_type, source_col, source_values = source_filter
+            final_query += f" AND {source_type}.{source_col} IN ({','.join(['?']*len(source_values))})"
+            params += list(source_values)
+
+        self.c.execute(final_query, params)
+        if compact:
+            return self._fetch_categorical(column_names)
+        return self._result_frame(self.c.fetchall(), column_names)
+
+
+    def _result_frame(self, results, column_names, compact = False):
+        if compact:
+            return pd.DataFrame({name: pd.Categorical([]) for name in column_names})
+        return pd.DataFrame(results, columns=column_names)
+
+
+    def _fetch_categorical(self, column_names, batch_size = 5000):
+        # Dictionary-encodes the query result as it's fetched, so each distinct identifier is held once no matter
+        # how many join rows it appears in, and the full list of result tuples is never built.
+        categories = [{} for _ in column_names]
+        codes = [array('l') for _ in column_names]
+        while True:
+            rows = self.c.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                for val, col_categories, col_codes in zip(row, categories, codes):
+                    col_codes.append(-1 if val is None else col_categories.setdefault(val, len(col_categories)))
+        return pd.DataFrame({name: pd.Categorical.from_codes(np.frombuffer(col_codes, dtype=np.dtype('l')) if len(col_codes) else [],
+                                                             categories=list(col_categories))
+                             for name, col_categories, col_codes in zip(column_names, categories, codes)})
+
+
+    def _index_by_inputs(self, result, ids, from_type, keep_source):
+        # Normalized lookups return the stored form of each identifier; re-key the rows by the identifiers as given.
+        inputs = pd.DataFrame({'_input': ids, '_key': [normalize_identifier(x, from_type) for x in ids]}).drop_duplicates()
+        result = result.assign(_key=[normalize_identifier(x, from_type) if isinstance(x, str) else None for x in result[from_type]])
+        result = inputs.merge(result, on='_key').drop(columns='_key').set_index('_input')
+        result.index.name = from_type
+        return result if keep_source else result.drop(columns=from_type)
+
+
+    def _drop_duplicate_rows(self, result, compact = False):
+        if compact:
+            # Categorical cells are always scalars, and converting them would undo the encoding
+            return result.drop_duplicates()
+        try:
+            dedup_ind = result.map(lambda x: x if not isinstance(x, list) else ','.join(x)).drop_duplicates().index
+        except AttributeError:
+            # Pandas went from not having .map() at all to having an annoying deprecation message on .applymap(), in one version! 
+            dedup_ind = result.applymap(lambda x: x if not isinstance(x, list) else ','.join(x)).drop_duplicates().index
+        return result.loc[dedup_ind]
 
-        if require_canonical:
-            # TODO test this more extensively!
-            for to_type in dest_types:
-                final_query += f" AND {to_type}.is_canonical = 1"
 
-        self.c.execute(final_query, [taxon]+entity_indices)
-        results = self.c.fetchall()
-        result_table = pd.DataFrame(results, columns=column_names)
-        return result_table[column_names[4:]]
+    def _format_result(self, result, format, compact = False):
+        if format == 'txt' and compact:
+            result = self._categorical_to_tsv(result)
+        elif format == 'txt':
+            try:
+                result = result.map(lambda x: ', '.join(x) if isinstance(x, list) else x)
+            except AttributeError:
+                result = result.applymap(lambda x: ', '.join(x) if isinstance(x, list) else x)
+            result = result.to_csv(sep='\t') 
+        elif format == 'json' or format == 'dict':
+            # result = result.to_dict(orient='dict')
+            ## None of the pandas to_dict options do quite what we want here.
+            d_lookup = {ftype:{ttype:[] for ttype in result.columns} for ftype in set(result.index)}
+            for acc, row in result.iterrows():
+                for acctype in result.columns:
+                    if pd.notna(row[acctype]):
+                        d_lookup[acc][acctype].append(row[acctype])
+            result = d_lookup
+        elif format == 'pandas' or format == None:
+            pass
+        else:
+            raise Exception(f"Return format {format} is not recognized.")
+        return result
+
+
+    def _categorical_to_tsv(self, result):
+        # Writes each cell as a reference into its column's category strings, rather than converting every cell.
+        columns = []
+        for col in [result.index] + [result[x] for x in result.columns]:
+            col = pd.Categorical(col)
+            labels = np.array([str(x) for x in col.categories] + [''], dtype=object)
+            columns.append(labels[col.codes])  # code -1 (missing) selects the trailing ''
+        lines = ['\t'.join([result.index.name or ''] + [str(x) for x in result.columns])]
+        lines.extend('\t'.join(row) for row in zip(*columns))
+        return '\n'.join(lines) + '\n'
 
 
+    @_on_snapshot
     def map(self, ids, from_type = None, to_types = None, taxon = None, require_canonical = None,
             format=None,
             return_query_info = False, 
             extensive = False, 
+            match = 'exact',
+            compact = False,
             ):
         """
         Converts a set of biological identifiers from one type to another.
@@ -167,10 +535,12 @@ class Accessive():
         - from_type (str, optional): The type of the input identifiers. If not specified, Accessive will attempt to infer the type.
         - to_types (str or list of str, optional): The target identifier types to convert to. If not provided, defaults to all gene-level accession types.
         - taxon (str, optional): The taxonomic species identifier; this is recommended to avoid ambiguity
-        - require_canonical (bool, optional): Only return canonical or 'recommended' identifiers (avoids less-common gene names, old versions of identifiers, etc.)
+        - require_canonical (bool, optional): Only return canonical or 'recommended' identifiers (avoids less-common gene names, old versions of identifiers, etc.) Where a destination has no canonical identifier, its cell is left empty; the rest of the row is still returned.
         - return_query_info (bool, optional): Return additional inforamtion about the query.
         - return_format (str, optional): The format of the returned data ('txt', 'json', 'pandas'). If not specified, returns a Pandas DataFrame.
         - extensive (bool, optional): Returns all relevant identifiers for the named genes/transcripts/proteins, including additional mappings back to the source accession type.
+        - match (str, optional): 'exact' (default), or 'normalized' to match source identifiers regardless of case and version/isoform suffixes (e.g. 'ENST00000361390.4' or 'p00750-1'). Results are reported under the identifiers as given.
+        - compact (bool, optional): Return categorical (dictionary-encoded) columns, built directly from the database results. This uses far less memory for large results, where the same identifiers repeat across many rows.
 
         Returns:
         A table (in pandas Dataframe, JSON, or text TSV format) containing the requested identifiers.
@@ -221,42 +591,29 @@ class Accessive():
             raise ValueError(f"Some destination identifier types are not recognized: {[x for x in to_types if x not in KNOWN_IDENTIFIERS]}")
 
 
-        result = self._query(ids, from_type, to_types, taxon, require_canonical)
+        if self.query_log is not None:
+            for to_type in to_types:
+                if to_type != from_type:
+                    self.query_log[(from_type, to_type, taxon)] += 1
 
-        try:
-            dedup_ind = result.map(lambda x: x if not isinstance(x, list) else ','.join(x)).drop_duplicates().index
-        except AttributeError:
-            # Pandas went from not having .map() at all to having an annoying deprecation message on .applymap(), in one version! 
-            dedup_ind = result.applymap(lambda x: x if not isinstance(x, list) else ','.join(x)).drop_duplicates().index
-        result = result.loc[dedup_ind]
+        self._recent_queries.append((tuple(ids[:WARM_IDS_PER_QUERY]), from_type, tuple(to_types), taxon, require_canonical, match, extensive))
+
+        result = self._query(ids, from_type, to_types, taxon, require_canonical, match, compact, extensive)
 
-        if not extensive:
-            result = result[result[from_type].isin(ids)]
+        result = self._drop_duplicate_rows(result, compact)
 
-        result = result.set_index(from_type, drop=(from_type not in to_types)) 
+        if not extensive and match == 'normalized':
+            result = self._index_by_inputs(result, ids, from_type, keep_source=(from_type in to_types))
+        else:
+            result = result.set_index(from_type, drop=(from_type not in to_types)) 
         
         # Lots of queries will return all-None rows, for various complicated reasons, usually of the form 
         # "rows correspond to proteoforms since a proteoform accession was requested, but some genes/transcripts
         # in the result are non-coding or missing" 
         result = result[~result.isnull().all(axis=1)]
 
-        if format == 'txt':
-            result = result.applymap(lambda x: ', '.join(x) if isinstance(x, list) else x)
-            result = result.to_csv(sep='\t') 
-        elif format == 'json' or format == 'dict':
-            # result = result.to_dict(orient='dict')
-            ## None of the pandas to_dict options do quite what we want here.
-            d_lookup = {ftype:{ttype:[] for ttype in result.columns} for ftype in set(result.index)}
-            for acc, row in result.iterrows():
-                for acctype in result.columns:
-                    if row[acctype] is not None:
-                        d_lookup[acc][acctype].append(row[acctype])
-            result = d_lookup
-        elif format == 'pandas' or format == None:
-            pass
-        else:
-            raise Exception(f"Return format {format} is not recognized.")
-        
+        result = self._format_result(result, format, compact)
+
         if return_query_info:
             return {'result': result, 'from_type': from_type, 'to_types': to_types, 'taxon': taxon}
         else:
@@ -286,14 +643,69 @@ class Accessive():
         return self.map(ids=accession, from_type=from_type, to_types=[to_type], taxon=taxon, format='pandas')[to_type].tolist() # type: ignore
 
 
+    @_on_snapshot
+    def search(self, text, taxon = None, to_types = None, require_canonical = None, format = None, limit = None, syntax = 'plain'):
+        """
+        Finds genes by full-text search over gene names and descriptions, and maps them to the requested identifier types.
 
+        Parameters:
+        - text (str): The search query. Genes matching all of the words are returned, and a trailing '*' matches any word starting with that prefix (e.g. 'kinas*').
+        - taxon (int, optional): The taxonomic species identifier to restrict the search to. If not specified, all species are searched.
+        - to_types (str or list of str, optional): The identifier types to return for each matching gene. Defaults to gene name and description.
+        - require_canonical (bool, optional): Only return canonical or 'recommended' identifiers.
+        - format (str, optional): The format of the returned data ('txt', 'json', 'pandas'). If not specified, returns a Pandas DataFrame.
+        - limit (int, optional): The maximum number of genes to return, best matches first.
+        - syntax (str, optional): 'plain' (default) matches the words of text literally; 'fts' passes text through as an SQLite FTS5 query, so 'OR', 'NOT', "quoted phrases" and the other FTS5 operators can be used.
 
+        Returns:
+        A table (in pandas Dataframe, JSON, or text TSV format) indexed by Ensembl gene ID, with matches in order of relevance.
 
+        Examples:
+        Find human kinases and their SwissProt accessions:
+        >>> accessive.search('kinase', taxon=9606, to_types=['gene_name', 'uniprot_swissprot'])
+        """
+        if not self._db.has_text_search:
+            raise RuntimeError("This database has no text search index; search() requires a database built with accessive.db_builder.build.build_text_search_index().")
+        if syntax == 'plain':
+            text = _quote_search_terms(text)
+        elif syntax != 'fts':
+            raise ValueError(f"syntax must be one of 'plain' or 'fts', not {syntax}.")
+        if not text.strip():
+            raise ValueError("Search text is empty.")
 
+        if isinstance(to_types, str):
+            to_types = [to_types]
+        if to_types is None:
+            to_types = ['gene_name', 'gene_description']
+        if not all(x in KNOWN_IDENTIFIERS for x in to_types):
+            raise ValueError(f"Some destination identifier types are not recognized: {[x for x in to_types if x not in KNOWN_IDENTIFIERS]}")
+        if taxon is None:
+            taxon = self.default_taxon
+        if require_canonical is None:
+            require_canonical = self.default_require_canonical
 
+        match_expr = f"text : ({text})" if taxon is None else f'taxon : "{int(taxon)}" AND text : ({text})'
+        self.c.execute(f"""SELECT taxon, entity_index, MIN(rank) FROM {TEXT_SEARCH_TABLE} WHERE {TEXT_SEARCH_TABLE} MATCH ?
+                           GROUP BY taxon, entity_index ORDER BY MIN(rank)""" + (" LIMIT ?" if limit is not None else ""),
+                       (match_expr, limit) if limit is not None else (match_expr,))
+        hits = [(int(x[0]), x[1]) for x in self.c.fetchall()]
 
+        dest_types = to_types if 'ensembl_gene' in to_types else ['ensembl_gene'] + to_types
+        type_meta = self._get_type_metadata(dest_types)
+        tables = []
+        for hit_taxon in sorted(set(x[0] for x in hits)):
+            gene_indices = [x[1] for x in hits if x[0] == hit_taxon]
+            tables.append(self._query_entities(hit_taxon, 'gene', gene_indices, dest_types, type_meta, require_canonical))
+        if not tables:
+            result = pd.DataFrame(columns=['taxon', 'gene_index'] + dest_types)
+        else:
+            result = pd.concat(tables)
 
+        ranks = {hit: i for i, hit in enumerate(hits)}
+        result = result.assign(_rank=[ranks[x] for x in zip(result['taxon'], result['gene_index'])])
+        result = result.sort_values('_rank', kind='stable')[dest_types]
+        result = self._drop_duplicate_rows(result)
+        result = result.set_index('ensembl_gene', drop=('ensembl_gene' not in to_types))
+        result = result[~result.isnull().all(axis=1)]
 
-
-
-
+        return self._format_result(result, format)
@@ -0,0 +1,377 @@
+import sys
+import json
+import time
+import queue
+import threading
+from collections import OrderedDict, deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from .interface import Accessive
+
+
+DEFAULT_PORT = 8765
+DEFAULT_POOL_SIZE = 4
+DEFAULT_BATCH_WINDOW = 0.005
+DEFAULT_MAX_BATCH = 5000
+DEFAULT_CACHE_SIZE = 100000
+
+
+class _Job():
+    def __init__(self, kind, key = None, ids = None, func = None):
+        self.kind = kind # 'map' jobs may be merged with others sharing their key; 'call' jobs run alone
+        self.key = key
+        self.ids = ids
+        self.func = func
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _ResultCache():
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            try:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return False, None
+
+    def put(self, key, value):
+        if not self.max_size:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class _Metrics():
+    def __init__(self, window = 10000):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.requests = {}
+        self.errors = 0
+        self.batches = 0
+        self.batched_jobs = 0
+        self.latencies = deque(maxlen=window) # (finish time, seconds)
+
+    def record_request(self, endpoint, latency, error = False):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.errors += int(error)
+            self.latencies.append((time.time(), latency))
+
+    def record_batch(self, n_jobs):
+        with self.lock:
+            self.batches += 1
+            self.batched_jobs += n_jobs
+
+    def summary(self, cache):
+        with self.lock:
+            now = time.time()
+            latencies = sorted(x[1] for x in self.latencies)
+            recent = sum(1 for x in self.latencies if now - x[0] <= 10)
+
+            def percentile(p):
+                return latencies[min(len(latencies) - 1, int(p*len(latencies)))]*1000 if latencies else None
+
+            return {'uptime_seconds': now - self.start_time,
+                    'requests': dict(self.requests),
+                    'errors': self.errors,
+                    'qps_10s': recent / min(10, max(now - self.start_time, 1e-9)),
+                    'latency_ms': {'p50': percentile(0.5), 'p95': percentile(0.95), 'p99': percentile(0.99)},
+                    'batches': self.batches,
+                    'mean_batch_size': self.batched_jobs / self.batches if self.batches else None,
+                    'cache': {'entries': len(cache.entries), 'hits': cache.hits, 'misses': cache.misses}}
+
+
+class MappingService():
+    """
+    Thread-safe front end for a pool of Accessive instances, shared between any number of callers.
+
+    Map requests that arrive within batch_window seconds of each other and share from_type, to_types, taxon and
+    require_canonical are merged into a single query. Per-identifier results are kept in a shared LRU cache of
+    cache_size entries. Requests without a taxon are never merged, since Accessive can't look up several species
+    in one query.
+    """
+    def __init__(self, sqlite_file = None, pool_size = DEFAULT_POOL_SIZE, batch_window = DEFAULT_BATCH_WINDOW,
+                 max_batch = DEFAULT_MAX_BATCH, cache_size = DEFAULT_CACHE_SIZE):
+        self.sqlite_file = sqlite_file
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.cache = _ResultCache(cache_size)
+        self.metrics = _Metrics()
+        self.jobs = queue.Queue()
+
+        self.instances = []
+        startup_errors = []
+        self.workers = [threading.Thread(target=self._worker, args=(self.instances, startup_errors), daemon=True)
+                        for _ in range(pool_size)]
+        for worker in self.workers:
+            worker.start()
+        while len(self.instances) + len(startup_errors) < pool_size:
+            time.sleep(0.01)
+        if startup_errors:
+            raise RuntimeError(f"Could not open the Accessive database for the mapping service: {startup_errors[0]}") from startup_errors[0]
+
+
+    def _worker(self, ready, startup_errors):
+        try:
+            acc = Accessive(self.sqlite_file) # One connection per worker, since a connection runs one query at a time
+        except Exception as err:
+            startup_errors.append(err)
+            return
+        ready.append(acc)
+        while True:
+            jobs = [self.jobs.get()]
+            deadline = time.time() + self.batch_window
+            n_ids = len(jobs[0].ids or [])
+            while n_ids < self.max_batch:
+                try:
+                    jobs.append(self.jobs.get(timeout=max(0, deadline - time.time())))
+                    n_ids += len(jobs[-1].ids or [])
+                except queue.Empty:
+                    break
+
+            groups = {}
+            for job in jobs:
+                if job.kind == 'map' and job.key[2] is not None:
+                    groups.setdefault(job.key, []).append(job)
+                else:
+                    groups[id(job)] = [job]
+            for group in groups.values():
+                self._run_group(acc, group)
+
+
+    def _run_group(self, acc, group):
+        try:
+            if group[0].kind == 'call':
+                group[0].result = group[0].func(acc)
+            else:
+                from_type, to_types, taxon, require_canonical = group[0].key
+                ids = list(dict.fromkeys(acc_id for job in group for acc_id in job.ids))
+                self.metrics.record_batch(len(group))
+                mapped = acc.map(ids, from_type=from_type, to_types=list(to_types), taxon=taxon,
+                                 require_canonical=require_canonical, format='json')
+                for acc_id in ids:
+                    self.cache.put(group[0].key + (acc_id,), mapped.get(acc_id))
+                for job in group:
+                    job.result = {acc_id: mapped[acc_id] for acc_id in job.ids if acc_id in mapped}
+        except Exception as err:
+            if len(group) > 1:
+                # Re-run separately so that one bad request doesn't fail everything it was batched with
+                for job in group:
+                    self._run_group(acc, [job])
+                return
+            group[0].error = err
+        for job in group:
+            job.done.set()
+
+
+    def _submit(self, job):
+        self.jobs.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+
+    def map(self, ids, from_type, to_types, taxon = None, require_canonical = False):
+        """
+        Maps identifiers as Accessive.map(..., format='json') would, returning {identifier: {to_type: [values]}}.
+        """
+        ids = [ids] if isinstance(ids, str) else list(ids)
+        to_types = [to_types] if isinstance(to_types, str) else to_types
+        key = (from_type, tuple(to_types), taxon, bool(require_canonical))
+
+        result = {}
+        missing = []
+        for acc_id in ids:
+            found, value = self.cache.get(key + (acc_id,))
+            if not found:
+                missing.append(acc_id)
+            elif value is not None:
+                result[acc_id] = value
+        if missing:
+            result.update(self._submit(_Job('map', key, missing)))
+        return result
+
+
+    def get(self, accession, from_type, to_type, taxon = None):
+        return self.map([accession], from_type, [to_type], taxon).get(accession, {}).get(to_type, [])
+
+
+    def identify(self, acc):
+        return self._submit(_Job('call', func=lambda instance: instance.identify(acc)))
+
+
+    def clear_cache(self):
+        self.cache.clear()
+
+
+    def reload(self, sqlite_file = None):
+        """
+        Switches every pooled connection to a new database file with Accessive.reload(), then drops cached results.
+        """
+        for acc in self.instances:
+            acc.reload(sqlite_file)
+        self.sqlite_file = self.instances[0].sqlite_file
+        self.cache.clear()
+
+
+def _make_handler(service, allow_reload = False):
+    class MappingRequestHandler(BaseHTTPRequestHandler):
+        def _respond(self, status, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._respond(200, service.metrics.summary(service.cache))
+            elif self.path == '/health':
+                self._respond(200, {'status': 'ok'})
+            else:
+                self._respond(404, {'error': f"Unknown endpoint {self.path}"})
+
+        def do_POST(self):
+            start = time.time()
+            endpoint = self.path.strip('/')
+            error = False
+            try:
+                args = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                if endpoint == 'map':
+                    payload = service.map(args['ids'], args['from_type'], args['to_types'], args.get('taxon'),
+                                          args.get('require_canonical', False))
+                elif endpoint == 'get':
+                    payload = service.get(args['accession'], args['from_type'], args['to_type'], args.get('taxon'))
+                elif endpoint == 'identify':
+                    payload = service.identify(args['accession'])
+                elif endpoint == 'reload' and allow_reload:
+                    # Only the configured file can be re-opened; clients never get to name a path on the server
+                    if 'database' in args:
+                        raise ValueError("reload does not take a database path; it re-opens the served database file.")
+                    service.reload()
+                    payload = {'database': service.sqlite_file}
+                else:
+                    self._respond(404, {'error': f"Unknown endpoint {self.path}"})
+                    return
+                self._respond(200, payload)
+            except Exception as err:
+                error = True
+                self._respond(400, {'error': f"{type(err).__name__}: {err}"})
+            finally:
+                service.metrics.record_request(endpoint, time.time() - start, error)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MappingRequestHandler
+
+
+def make_server(service, host = '127.0.0.1', port = DEFAULT_PORT, allow_reload = False):
+    """
+    Returns an HTTP server for the service. POST /reload, which re-opens the served database file (e.g. after a new
+    release has been copied over it), is only enabled with allow_reload=True.
+    """
+    return ThreadingHTTPServer((host, port), _make_handler(service, allow_reload))
+
+
+def run_load_test(url, ids, from_type, to_types, taxon = None, n_requests = 1000, concurrency = 16, ids_per_request = 1):
+    """
+    Sends n_requests /map requests of ids_per_request identifiers each to a running server, from concurrency
+    threads at once, and returns client-side throughput and latency figures.
+    """
+    import random
+    import requests
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(n_requests))
+
+    def client():
+        session = requests.Session()
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            body = {'ids': random.sample(ids, min(ids_per_request, len(ids))), 'from_type': from_type,
+                    'to_types': to_types, 'taxon': taxon}
+            start = time.time()
+            res = session.post(url.rstrip('/') + '/map', json=body)
+            with lock:
+                latencies.append(time.time() - start)
+                errors[0] += int(res.status_code != 200)
+
+    start = time.time()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    return {'requests': len(latencies), 'errors': errors[0], 'seconds': elapsed, 'qps': len(latencies) / elapsed,
+            'latency_ms': {p: latencies[min(len(latencies) - 1, int(float(p[1:])/100*len(latencies)))]*1000
+                           for p in ['p50', 'p95', 'p99']}}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve Accessive map/get/identify over HTTP/JSON")
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Port to listen on')
+    parser.add_argument('--database', default=None, help='SQLite database file (default: the installed database)')
+    parser.add_argument('--pool-size', type=int, default=DEFAULT_POOL_SIZE, help='Number of database connections')
+    parser.add_argument('--batch-window-ms', type=float, default=DEFAULT_BATCH_WINDOW*1000, help='How long to wait for requests to batch together')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE, help='Maximum number of cached identifier results')
+    parser.add_argument('--allow-reload', action='store_true', help='Enable POST /reload, which re-opens the database file')
+    parser.add_argument('--load-test', action='store_true', help='Start the server on localhost and run a load test against it')
+    parser.add_argument('--from-type', default='gene_name', help='(load test) Source identifier type')
+    parser.add_argument('--to-types', default='uniprot_swissprot', help='(load test) Comma-separated destination types')
+    parser.add_argument('--taxon', type=int, default=9606, help='(load test) Taxon to sample identifiers from')
+    parser.add_argument('--requests', type=int, default=1000, help='(load test) Number of requests to send')
+    parser.add_argument('--concurrency', type=int, default=16, help='(load test) Number of concurrent clients')
+    parser.add_argument('--ids-per-request', type=int, default=1, help='(load test) Identifiers per request')
+    args = parser.parse_args()
+
+    service = MappingService(args.database, args.pool_size, args.batch_window_ms/1000, cache_size=args.cache_size)
+
+    if args.load_test:
+        server = make_server(service, '127.0.0.1', 0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+        sample = service._submit(_Job('call', func=lambda acc: [x[0] for x in acc.c.execute(
+            f"SELECT identifier FROM {args.from_type} WHERE taxon = ? LIMIT 10000", (args.taxon,))]))
+        print(f"Load testing {url} with {len(sample)} sampled {args.from_type} identifiers...", file=sys.stderr)
+        report = run_load_test(url, sample, args.from_type, args.to_types.split(','), args.taxon,
+                               args.requests, args.concurrency, args.ids_per_request)
+        print(json.dumps({'client': report, 'server': service.metrics.summary(service.cache)}, indent=2))
+        server.shutdown()
+    else:
+        server = make_server(service, args.host, args.port, args.allow_reload)
+        print(f"Serving Accessive on http://{args.host}:{server.server_address[1]}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass